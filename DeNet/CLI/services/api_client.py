@@ -1,10 +1,57 @@
 import os.path
 import pathlib
 import asyncio
+import hashlib
+import random
 
 import aiofiles
 import aiohttp
-import requests
+
+from .archive import ArchiveException, Member, PackedDirectory
+from .cell_codecs import Codec, CodecException
+
+CELL_SIZE = 1024 * 1024
+CELL_SIZE_MIN = 64 * 1024
+CELL_SIZE_MAX = 64 * 1024 * 1024
+# adaptive cell size aims at this many cells per file
+# and at most CELL_SECONDS of transfer per cell on a known link
+TARGET_CELLS = 512
+CELL_SECONDS = 5
+UPLOAD_WINDOW = 16
+UPLOAD_MAX_MEMORY = 256 * 1024 * 1024
+KNOWN_CELLS_PAGE = 1000
+UPLOAD_RETRIES = 5
+DOWNLOAD_PARTS = 4
+DOWNLOAD_CHUNK = 256 * 1024
+MANIFEST_PAGE = 10000
+MEMBERS_PAGE = 5000
+STORAGE_PAGE = 100
+STORAGE_PAGE_MAX = 1000
+UPLOAD_BACKOFF = 0.5
+# no total limit: big cells and whole-file downloads take long, stalls are caught by sock_read
+CLIENT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=15)
+CONNECTION_LIMIT = 100
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 300
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def choose_cell_size(file_size, link_speed=None, min_size=CELL_SIZE_MIN, max_size=CELL_SIZE_MAX):
+    """Picks a power of two cell size so the file takes about TARGET_CELLS cells,
+    and a cell takes no more than CELL_SECONDS on a link of link_speed bytes/s"""
+    cell_size = file_size // TARGET_CELLS
+    if link_speed:
+        cell_size = min(cell_size, int(link_speed * CELL_SECONDS))
+    cell_size = min(max(cell_size, min_size), max_size)
+    power = 1 << (cell_size.bit_length() - 1)
+    return power if power >= min_size else cell_size
+
+
+def count_cells(file_size, cell_size):
+    return -(-file_size // cell_size)
 
 
 class Status:
@@ -22,20 +69,96 @@ class Status:
 class APIClientException(Exception):
     pass
 
-class APIClient:
+class KnownDigests:
+    """Digests of the blobs the server has for the user. Cells ask about their digests as soon as
+    they are hashed, the digests asked while a request is in flight go together in the next one"""
+
+    def __init__(self, client):
+        self.client = client
+        self.known = set()
+        self._pending = {}
+        self._task = None
+
+    def add(self, digest):
+        self.known.add(digest)
+
+    async def check(self, digest):
+        if digest in self.known:
+            return True
+        future = self._pending.get(digest)
+        if future is None:
+            future = self._pending[digest] = asyncio.get_running_loop().create_future()
+            if self._task is None:
+                self._task = asyncio.create_task(self._ask())
+        return await asyncio.shield(future)
+
+    async def _ask(self):
+        while self._pending:
+            pending, self._pending = self._pending, {}
+            try:
+                known = await self.client._get_known_digests(list(pending))
+            except Exception as err:
+                for future in pending.values():
+                    future.set_exception(err)
+                continue
+            self.known.update(known)
+            for digest, future in pending.items():
+                future.set_result(digest in known)
+        self._task = None
+
+
+class AsyncAPIClient:
+    """Client which owns one long-lived aiohttp session for every endpoint,
+    use it as `async with AsyncAPIClient(...) as client` or call close()"""
 
     endpoints = {
         "storage": "/storage",
         "download_cell": "/download",
-        "download_init": "/download_init",
+        "manifest": "/manifest",
+        "members": "/members",
+        "download_file": "/files",
         "upload": "/upload_init",
         "upload_cell": "/upload",
+        "upload_status": "/upload_status",
+        "upload_raw_cell": "/cells",
+        "known_cells": "/cells/known",
         "register": "/register",
     }
 
-    def __init__(self, server, api_key):
+    def __init__(self, server, api_key, retries=UPLOAD_RETRIES, backoff=UPLOAD_BACKOFF,
+                 limit=CONNECTION_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT, dns_cache_ttl=DNS_CACHE_TTL,
+                 trace_configs=None):
         self.server = server
         self.api_key = api_key
+        self.retries = retries
+        self.backoff = backoff
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.trace_configs = trace_configs
+        self._session = None
+
+    def _get_session(self):
+        """The session is created lazily inside the running event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, keepalive_timeout=self.keepalive_timeout, ttl_dns_cache=self.dns_cache_ttl
+            )
+            self._session = aiohttp.ClientSession(
+                timeout=CLIENT_TIMEOUT, connector=connector, trace_configs=self.trace_configs
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
 
     def _get_api_key_header(self):
         return {"api-key": self.api_key}
@@ -45,134 +168,529 @@ class APIClient:
         return self.server + self.endpoints.get(endpoint)
 
 
-    def upload_file(self, path):
+    async def upload_file(self, path, window=UPLOAD_WINDOW, max_memory=UPLOAD_MAX_MEMORY, raw=True, dedup=True,
+                    resume=None, packed=False, cell_size=None, link_speed=None,
+                    min_cell_size=CELL_SIZE_MIN, max_cell_size=CELL_SIZE_MAX, codec="none"):
+        """Uploads file to a new storage. With resume=<session> re-sends only
+        the cells which the server hasn't got for this upload session.
+        Without cell_size it is chosen from the file size and link_speed (bytes/s).
+        With codec cells are compressed before upload, the server stores them as is.
+        A directory is uploaded recursively as one storage: its files are packed
+        one after another into shared cells and their offsets are sent as the archive index.
+        Returns id of the storage"""
         path = pathlib.Path(path)
         name = path.name
-        file_size = os.path.getsize(path)
-        size = file_size //1024 //1024
-        if os.path.getsize(path) % 1024 % 1024 != 0:
-            size += 1
-        upload_init = self._get_upload_session(size, name)
-        upload_session = upload_init.get("session")
-
-        results = self._upload_run(upload_session, path, size)
+        if path.is_dir():
+            path = PackedDirectory.scan(path)
+            file_size = path.size
+        else:
+            file_size = os.path.getsize(path)
+        archive = isinstance(path, PackedDirectory)
+        if resume:
+            upload_session = resume
+            upload_status = await self._get_upload_status(upload_session)
+            cell_size = upload_status.get("cell_size")
+            codec = upload_status.get("codec", "none")
+            # the layout is the one of the session, not of the command line
+            packed = upload_status.get("layout") == "packed"
+            if (upload_status.get("size") != count_cells(file_size, cell_size)
+                    or upload_status.get("archive", False) != archive):
+                raise APIClientException("The file doesn't match the upload session")
+            pk = upload_status.get("pk")
+            storage_id = pk if raw else None
+            addresses = upload_status.get("missing")
+        else:
+            if cell_size is None:
+                max_cell_size = min(max_cell_size, max_memory) if max_memory else max_cell_size
+                cell_size = choose_cell_size(file_size, link_speed, min_cell_size, max_cell_size)
+            size = count_cells(file_size, cell_size)
+            upload_init = await self._get_upload_session(
+                size, name, "packed" if packed else "cells", cell_size, codec, archive
+            )
+            upload_session = upload_init.get("session")
+            cell_size = upload_init.get("cell_size")
+            pk = upload_init.get("pk")
+            storage_id = pk if raw else None
+            addresses = None
+        if archive:
+            # sent again on resume, the server keeps the members it already has
+            await self._send_members(upload_session, path.members)
+
+        window = self._get_upload_window(window, max_memory, cell_size)
+        # packed storages keep cells in one data file and can't share content-addressed blobs
+        dedup = dedup and raw and not packed
+        try:
+            with Codec(codec) as cell_codec:
+                results = await self._async_upload(
+                    upload_session, path, window, cell_size, storage_id, dedup, addresses, cell_codec
+                )
+        except CodecException as err:
+            raise APIClientException(str(err))
         wrong_addresses = []
         for result in results:
             address, status = result
             if status != 201:
                 wrong_addresses.append(address)
         if wrong_addresses:
-            raise APIClientException(f"Couldn't upload: {wrong_addresses}")
-        pass
-
-    def _upload_run(self, upload_session, path, size):
-        res = asyncio.run(self._async_upload(upload_session, path, size))
-        return res
-
-
-    async def _async_upload(self, upload_session, path, size):
-        file_gen = self._split_file(path)
-        tasks = []
+            raise APIClientException(
+                f"Couldn't upload: {sorted(wrong_addresses)}. Resume with --resume {upload_session}"
+            )
+        return pk
+
+    @staticmethod
+    def _get_upload_window(window, max_memory, cell_size):
+        """Number of cells allowed in flight: bounded by window and by memory cap"""
+        if window < 1:
+            raise APIClientException("Upload window must be at least 1 cell")
+        if max_memory is not None:
+            window = min(window, max_memory // cell_size)
+            if window < 1:
+                raise APIClientException(
+                    f"Memory cap {max_memory} bytes is smaller than one cell ({cell_size} bytes)"
+                )
+        return window
+
+    async def _async_upload(self, upload_session, path, window, cell_size, storage_id=None, dedup=False,
+                            addresses=None, codec=None):
+        """Sliding window upload: at most `window` cells are in memory and in flight,
+        the next chunk is read from disk only when one of them is finished.
+        If storage_id is given cells are sent as raw body, otherwise as multipart form.
+        With dedup cells are content-addressed and bodies the server already has are skipped.
+        If addresses are given only these cells are uploaded. Cells are compressed by codec"""
         name = path.name
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(15)) as client:
-            for i in range(size):
-                address, data = await file_gen.__anext__()
-                task = self._upload_task(client, upload_session, address, name, data)
+        tasks = []
+        pending = set()
+        codec = codec or Codec()
+        known = KnownDigests(self) if dedup else None
+
+        async def upload_cell(address, data):
+            if storage_id is None:
+                data = await codec.compress(data)
+                return await self._upload_task(upload_session, address, name, data)
+            if known is None:
+                data = await codec.compress(data)
+                return await self._upload_raw_task(upload_session, storage_id, address, data)
+            # the cell is compressed and hashed once, by one job of the pool
+            data, digest = await codec.compress_with_digest(data)
+            if await known.check(digest):
+                data = b""
+            result = await self._upload_raw_task(upload_session, storage_id, address, data, digest)
+            if result[1] == 201:
+                known.add(digest)
+            return result
+
+        def finish(task):
+            pending.discard(task)
+            slots.release()
+
+        # a slot is taken before the chunk is read, so no cell waits in memory for a free slot
+        slots = asyncio.Semaphore(window)
+        cells = self._split_file(path, cell_size, addresses)
+        try:
+            while True:
+                await slots.acquire()
+                try:
+                    cell = await cells.__anext__()
+                except StopAsyncIteration:
+                    break
+                task = asyncio.create_task(upload_cell(*cell))
+                # the task holds the only reference to the chunk
+                cell = None
+                pending.add(task)
                 tasks.append(task)
-            # tasks = [write_to_disk(path, address, data) for i in range(12)]
-            return await asyncio.gather(*tasks)
+                task.add_done_callback(finish)
+        finally:
+            await cells.aclose()
+        if pending:
+            await asyncio.wait(pending)
+        return [task.result() for task in tasks]
 
 
-    async def _upload_task(self, client, upload_session, address, file_name, file_data):
+    async def _upload_task(self, upload_session, address, file_name, file_data):
         headers = self._get_api_key_header()
         headers["session"] = upload_session
+        # lets the server reject a wrong address before it reads the form
+        headers["address"] = str(address)
 
         content_type = "application/octet-stream"
-        data = aiohttp.FormData()
-        data.add_field(
-            name="file",
-            value=file_data,
-            filename=file_name,
-            content_type=content_type,
-        )
-        data.add_field(
-            name="number",
-            value=str(address)
+
+        async def send():
+            data = aiohttp.FormData()
+            data.add_field(
+                name="file",
+                value=file_data,
+                filename=file_name,
+                content_type=content_type,
+            )
+            data.add_field(
+                name="number",
+                value=str(address)
+            )
+            async with self._get_session().post(self._get_endpoint("upload_cell"), headers=headers, data=data,
+                                                ssl=False) as response:
+                return response.status
+
+        return address, await self._send_with_retries(
+            send, lambda: self._is_cell_stored(upload_session, address)
         )
 
-        async with client.post(self._get_endpoint("upload_cell"), headers=headers, data=data, ssl=False) as response:
-            # print(response.status)
-            # result = await response.read()
-            return address, response.status
+
+    async def _upload_raw_task(self, upload_session, storage_id, address, file_data, digest=None):
+        headers = self._get_api_key_header()
+        headers["session"] = upload_session
+        headers["Content-Type"] = "application/octet-stream"
+        if digest is not None:
+            headers["digest"] = digest
+        url = self._get_endpoint("upload_raw_cell") + f"/{storage_id}/{address}"
+
+        async def send():
+            async with self._get_session().put(url, headers=headers, data=file_data, ssl=False) as response:
+                return response.status
+
+        return address, await self._send_with_retries(
+            send, lambda: self._is_cell_stored(upload_session, address)
+        )
 
 
-    async def _split_file(self, file_path):
+    def _get_backoff(self, attempt):
+        """Exponential backoff with jitter before the retry number attempt"""
+        return self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+    async def _send_with_retries(self, send, is_stored=None):
+        """Retries network errors and 5xx answers with exponential backoff, returns last status.
+        A conflict on a retry is a success only if is_stored confirms the server has the cell:
+        the previous attempt was stored but its answer was lost. Otherwise the cell may still
+        be written by the previous attempt, the conflict is retried too"""
+        status = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self._get_backoff(attempt))
+            try:
+                status = await send()
+                if status == 409 and attempt and is_stored is not None:
+                    if await is_stored():
+                        return 201
+                    continue
+            except (aiohttp.ClientError, asyncio.TimeoutError, APIClientException):
+                status = None
+                continue
+            if status < 500:
+                return status
+        return status
+
+
+    async def _is_cell_stored(self, upload_session, address):
+        """True if the upload session has the cell committed"""
+        upload_status = await self._get_upload_status(upload_session)
+        return address not in upload_status["missing"]
+
+
+    async def _get_known_digests(self, digests):
+        """Asks the server which of the digests it already has, by pages"""
+        unique = list(dict.fromkeys(digests))
+        known = set()
+        for start in range(0, len(unique), KNOWN_CELLS_PAGE):
+            page = unique[start:start + KNOWN_CELLS_PAGE]
+            async with self._get_session().post(self._get_endpoint("known_cells"),
+                                                headers=self._get_api_key_header(),
+                                                json={"digests": page}, ssl=False) as response:
+                if response.status != 200:
+                    raise APIClientException("The server rejected the request for known cells")
+                result = await response.json()
+                known.update(result.get("digests"))
+        return known
+
+
+    async def _send_members(self, upload_session, members):
+        """Sends the archive index by pages"""
+        headers = self._get_api_key_header()
+        headers["session"] = upload_session
+        for start in range(0, len(members), MEMBERS_PAGE):
+            page = [member._asdict() for member in members[start:start + MEMBERS_PAGE]]
+            async with self._get_session().post(self._get_endpoint("members"), headers=headers,
+                                                json={"start": start, "members": page}, ssl=False) as response:
+                if response.status != 201:
+                    raise APIClientException("The server rejected the archive index")
+
+    async def _get_members(self, storage_id):
+        """The whole archive index"""
+        members = []
+        after = None
+        while True:
+            params = {"limit": MEMBERS_PAGE}
+            if after is not None:
+                params["after"] = after
+            async with self._get_session().get(url=self._get_endpoint("members") + f"/{storage_id}",
+                                               params=params, headers=self._get_api_key_header()) as result:
+                if result.status != 200:
+                    raise APIClientException(f"The server rejected the request for storage ID={storage_id}")
+                page = await result.json()
+            members.extend(Member(**member) for member in page.get("members"))
+            after = page.get("next")
+            if after is None:
+                return members
+
+    async def _split_file(self, file_path, cell_size=CELL_SIZE, addresses=None):
+        if isinstance(file_path, PackedDirectory):
+            if addresses is None:
+                addresses = range(count_cells(file_path.size, cell_size))
+            for address in addresses:
+                yield address, await asyncio.to_thread(file_path.read, address * cell_size, cell_size)
+            return
+        if addresses is not None:
+            async with aiofiles.open(file_path, mode='rb') as f:
+                for address in addresses:
+                    await f.seek(address * cell_size)
+                    yield address, await f.read(cell_size)
+            return
         address = 0
         async with aiofiles.open(file_path, mode='rb') as f:
-            data = await f.read(1024 * 1024)
+            data = await f.read(cell_size)
             address = 0
             while data:
                 # async with aiofiles.open("file", mode='wb') as f:
                 #     await f.write(data)
                 yield address, data
-                data = await f.read(1024 * 1024)
+                data = await f.read(cell_size)
                 address += 1
 
 
-    def _get_upload_session(self, size, name):
-        result = requests.post(
+    async def _get_upload_status(self, upload_session):
+        headers = self._get_api_key_header()
+        headers["session"] = upload_session
+        async with self._get_session().get(url=self._get_endpoint("upload_status"), headers=headers) as result:
+            if result.status != 200:
+                raise APIClientException(f"The server rejected the request for upload session {upload_session}")
+            return await result.json()
+
+    async def _get_upload_session(self, size, name, layout="cells", cell_size=None, codec="none", archive=False):
+        async with self._get_session().post(
             url=self._get_endpoint("upload"),
             headers=self._get_api_key_header(),
-            json={"size": size, "name": name}
-        )
-        if result.status_code != 201:
-            raise APIClientException("The server rejected the request for upload session")
-        return result.json()
-
-    def download(self, storage_id, save_path):
-        storage:dict = self._download_init(storage_id)
-        file_name = storage.get("name")
-        size = int(storage.get("size"))
-        cells = storage.get("cells")
-        if size != len(cells):
-            raise Exception("file is not OK!")
+            json={"size": size, "name": name, "layout": layout, "cell_size": cell_size, "codec": codec,
+                  "archive": archive}
+        ) as result:
+            if result.status != 201:
+                raise APIClientException("The server rejected the request for upload session")
+            return await result.json()
+
+    async def download(self, storage_id, save_path, direct=True, page_size=MANIFEST_PAGE):
+        """Downloads the storage cell by cell. Cells of a manifest page start downloading
+        while the next pages are still being fetched. An archive is extracted into
+        the directory save_path/<name>. Returns the first manifest page"""
+        pages = self._iter_manifest(storage_id, page_size)
+        manifest = await anext(pages)
+        file_name = manifest.get("name")
+        size = int(manifest.get("size"))
+        cell_size = int(manifest.get("cell_size", CELL_SIZE))
+        cells = self._iter_manifest_cells(manifest, pages)
         status = Status(0)
-        result = self._download_run(size, cells, save_path, status)
+        try:
+            with Codec(manifest.get("codec", "none")) as codec:
+                if manifest.get("archive"):
+                    directory = PackedDirectory(
+                        pathlib.Path(save_path, file_name), await self._get_members(storage_id)
+                    )
+                    result = await self._async_download_archive(cells, directory, status, cell_size, codec)
+                elif direct:
+                    file_path = f'{save_path}/{file_name}'
+                    result = await self._async_download_direct(cells, size, file_path, status, cell_size, codec)
+                else:
+                    result = await self._async_download(cells, save_path, status, codec)
+        except (CodecException, ArchiveException) as err:
+            raise APIClientException(str(err))
+        if size != len(result):
+            raise APIClientException(f"Storage has {len(result)} of {size} cells, it is not uploaded completely")
         if False in result:
             raise APIClientException("Couldn't download this file. The server rejected request.")
-        self._compose_file(size, file_name, save_path)
-        return storage
-
-
-    def _download_run(self, size, cells, save_path, status):
-        res = asyncio.run(self._async_download(size, cells, save_path, status))
-        return res
-
-
-    async def _async_download(self, size, cells, save_path, status):
+        if not direct and not manifest.get("archive"):
+            self._compose_file(size, file_name, save_path)
+        return manifest
+
+    async def _iter_manifest(self, storage_id, page_size=MANIFEST_PAGE):
+        after = None
+        while True:
+            params = {"limit": page_size}
+            if after is not None:
+                params["after"] = after
+            async with self._get_session().get(url=self._get_endpoint("manifest") + f"/{storage_id}",
+                                               params=params, headers=self._get_api_key_header()) as result:
+                if result.status != 200:
+                    raise APIClientException(f"The server rejected the request for storage ID={storage_id}")
+                page = await result.json()
+            yield page
+            after = page.get("next")
+            if after is None:
+                return
+
+    @staticmethod
+    async def _iter_manifest_cells(manifest, pages):
+        """Yields cells of the first manifest page and then of the pages fetched after it
+        in the same form as /download_init cells"""
+        page = manifest
+        cell_size = int(manifest.get("cell_size", CELL_SIZE))
+        packed = manifest.get("layout") == "packed"
+        while page is not None:
+            template = page.get("path_template")
+            columns = page.get("cells")
+            paths = columns.get("path")
+            lengths = columns.get("length")
+            for index, address in enumerate(columns.get("address")):
+                yield {
+                    "address": address,
+                    "path": template.replace("{address}", str(address)) if template else paths[index],
+                    "digest": columns.get("digest")[index],
+                    "offset": address * cell_size if packed else None,
+                    "length": lengths[index] if lengths else None,
+                }
+            page = await anext(pages, None)
+
+    @staticmethod
+    async def _gather_cells(cells, download_cell):
+        """Starts a download task per cell as soon as the cell is known,
+        returns the results in manifest order"""
         tasks = []
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(15)) as client:
-            for cell in cells:
-                task = self._download_cell(client, cell, save_path, status)
-                tasks.append(task)
-            return await asyncio.gather(*tasks)
+        try:
+            async for cell in cells:
+                tasks.append(asyncio.create_task(download_cell(cell)))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return await asyncio.gather(*tasks)
+
+    async def download_whole(self, storage_id, save_path, parts=DOWNLOAD_PARTS):
+        """Downloads the whole file by one request per part using Range requests,
+        returns path of the downloaded file"""
+        url = self._get_endpoint("download_file") + f"/{storage_id}"
+        headers = self._get_api_key_header()
+        headers["Range"] = "bytes=0-0"
+        async with self._get_session().get(url, headers=headers) as response:
+            if response.status == 206:
+                total = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+            elif response.status == 416:
+                total = 0
+            else:
+                raise APIClientException(f"The server rejected the request for storage ID={storage_id}")
+            file_name = pathlib.Path(response.content_disposition.filename).name
+        file_path = f'{save_path}/{file_name}'
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, total)
+            part_size = -(-total // parts) if total else 0
+            tasks = [
+                self._download_range(url, fd, start, min(start + part_size, total) - 1)
+                for start in range(0, total, part_size or 1)
+            ]
+            result = await asyncio.gather(*tasks)
+        finally:
+            os.close(fd)
+        if False in result:
+            raise APIClientException("Couldn't download this file. The server rejected request.")
+        return file_path
 
+    async def _download_range(self, url, fd, start, end):
+        headers = self._get_api_key_header()
+        headers["Range"] = f"bytes={start}-{end}"
+        async with self._get_session().get(url, headers=headers) as response:
+            if response.status != 206:
+                return False
+            offset = start
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK):
+                await asyncio.to_thread(os.pwrite, fd, chunk, offset)
+                offset += len(chunk)
+            return offset == end + 1
+
+    async def _async_download_direct(self, cells, size, file_path, status, cell_size, codec=None):
+        """Download cells straight into the preallocated output file,
+        each cell is written at address * cell_size"""
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size * cell_size)
+            result = await self._gather_cells(
+                cells, lambda cell: self._download_cell_at(cell, fd, status, cell_size, codec)
+            )
+            if result and False not in result:
+                # the last cell is usually shorter than cell_size
+                os.ftruncate(fd, max(result))
+        finally:
+            os.close(fd)
+        return result
+
+    async def _download_cell_at(self, cell, fd, status, cell_size, codec=None):
+        """Returns end offset of written cell or False"""
+        offset = cell.get("address") * cell_size
+        result = await self._fetch_cell(cell, codec)
+        if result is None:
+            return False
+        await asyncio.to_thread(os.pwrite, fd, result, offset)
+        status.increment()
+        return offset + len(result)
+
+
+    async def _async_download_archive(self, cells, directory, status, cell_size, codec=None):
+        """Creates the member files and scatters every downloaded cell over them"""
+        await asyncio.to_thread(directory.create_files)
+        return await self._gather_cells(
+            cells, lambda cell: self._download_cell_into(cell, directory, status, cell_size, codec)
+        )
 
-    async def _download_cell(self, client, cell, save_path, status):
+    async def _download_cell_into(self, cell, directory, status, cell_size, codec=None):
+        result = await self._fetch_cell(cell, codec)
+        if result is None:
+            return False
+        await asyncio.to_thread(directory.write, cell.get("address") * cell_size, result)
+        status.increment()
+        return True
+
+    async def _fetch_cell(self, cell, codec=None):
+        """Downloads the cell and checks it against its digest in a thread,
+        a failed, corrupted or truncated cell is re-fetched with backoff.
+        Returns decompressed content or None on failure"""
+        headers = self._get_cell_headers(cell)
+        url = self._get_endpoint("download_cell") + "/" + cell.get("path")
+        digest = cell.get("digest")
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self._get_backoff(attempt))
+            try:
+                async with self._get_session().get(url, headers=headers) as response:
+                    if response.status not in (200, 206):
+                        if response.status < 500:
+                            return None
+                        continue
+                    result = await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+            if digest is None or await asyncio.to_thread(sha256_hex, result) == digest:
+                return await codec.decompress(result) if codec else result
+        return None
+
+
+    async def _async_download(self, cells, save_path, status, codec=None):
+        return await self._gather_cells(cells, lambda cell: self._download_cell(cell, save_path, status, codec))
+
+
+    def _get_cell_headers(self, cell):
+        """Cells of a packed storage share one data file and are read by Range"""
         headers = self._get_api_key_header()
-        url = cell.get("path")
-        address = cell.get("address")
+        offset = cell.get("offset")
+        if offset is not None:
+            headers["Range"] = f"bytes={offset}-{offset + cell.get('length') - 1}"
+        return headers
 
-        async with client.get(self._get_endpoint("download_cell") + "/" + url,
-                               headers=headers) as response:
-            if response.status == 200:
-                result = await response.read()
-                await self._write_to_disk(result, address, save_path)
-                status.increment()
-                status.increment()
-                return True
-            else:
-                return False
+
+    async def _download_cell(self, cell, save_path, status, codec=None):
+        address = cell.get("address")
+        result = await self._fetch_cell(cell, codec)
+        if result is None:
+            return False
+        await self._write_to_disk(result, address, save_path)
+        status.increment()
+        status.increment()
+        return True
 
 
     async def _write_to_disk(self, content: bytes, id: int, save_path:str):
@@ -181,23 +699,41 @@ class APIClient:
             await f.write(content)
 
 
-    def _download_init(self, storage_id):
-        result = requests.get(
-            url=self._get_endpoint("download_init"),
-            headers=self._get_api_key_header(),
-            json={"id": storage_id}
-        )
-        if result.status_code != 200:
-            raise APIClientException(f"The server rejected the request for storage ID={storage_id}")
-        return result.json()
-
-
-    def storage_list(self):
-        result = requests.get(url=self._get_endpoint("storage"), headers=self._get_api_key_header())
-        if result.status_code != 200:
-            raise APIClientException(f"The server rejected the request for storage list")
-        return result.json()
-
+    async def storage_list(self, after=None, limit=STORAGE_PAGE):
+        """One page of the storage list, newest first. after is the "next" cursor of the previous page"""
+        params = {"limit": limit}
+        if after is not None:
+            params["after"] = after
+        async with self._get_session().get(url=self._get_endpoint("storage"), params=params,
+                                           headers=self._get_api_key_header()) as result:
+            if result.status != 200:
+                raise APIClientException(f"The server rejected the request for storage list")
+            return await result.json()
+
+    async def iter_storage(self, page_size=STORAGE_PAGE):
+        """Yields all storages, the next page is requested only when the previous one is consumed"""
+        after = None
+        while True:
+            page = await self.storage_list(after, page_size)
+            for storage in page.get("storage_list"):
+                yield storage
+            after = page.get("next")
+            if after is None:
+                return
+
+
+    async def delete_storage(self, storage_ids):
+        """Deletes storages, returns ids of the deleted ones. Missing and foreign ids are skipped"""
+        deleted = []
+        for start in range(0, len(storage_ids), STORAGE_PAGE_MAX):
+            async with self._get_session().delete(url=self._get_endpoint("storage"),
+                                                  headers=self._get_api_key_header(),
+                                                  json={"ids": storage_ids[start:start + STORAGE_PAGE_MAX]}
+                                                  ) as result:
+                if result.status != 200:
+                    raise APIClientException("The server rejected the request for storage deletion")
+                deleted.extend((await result.json()).get("deleted"))
+        return deleted
 
     def _compose_file(self, size, file_name, path):
         with open(f'{path}/{file_name}', "wb") as file:
@@ -211,11 +747,60 @@ class APIClient:
                     raise APIClientException(f"No this file {size}")
 
 
-    def register(self, name):
-        result = requests.post(
+    async def register(self, name):
+        async with self._get_session().post(
             url=self._get_endpoint("register"),
             json={"api_key": self.api_key, "name": name}
-        )
-        if result != 201:
-            raise APIClientException(f"The server rejected the request for registry. Probably wrong api-key")
-        return result.json()
+        ) as result:
+            if result.status != 201:
+                raise APIClientException(f"The server rejected the request for registry. Probably wrong api-key")
+            return await result.json()
+
+
+class APIClient:
+    """Blocking wrapper over AsyncAPIClient. It keeps its own event loop,
+    so the pooled connections survive between calls until close()"""
+
+    def __init__(self, server, api_key, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._client = AsyncAPIClient(server, api_key, **kwargs)
+
+    def _run(self, coro):
+        return self._loop.run_until_complete(coro)
+
+    def upload_file(self, path, **kwargs):
+        return self._run(self._client.upload_file(path, **kwargs))
+
+    def download(self, storage_id, save_path, direct=True):
+        return self._run(self._client.download(storage_id, save_path, direct=direct))
+
+    def download_whole(self, storage_id, save_path, parts=DOWNLOAD_PARTS):
+        return self._run(self._client.download_whole(storage_id, save_path, parts=parts))
+
+    def storage_list(self, after=None, limit=STORAGE_PAGE):
+        return self._run(self._client.storage_list(after, limit))
+
+    def iter_storage(self, page_size=STORAGE_PAGE):
+        pages = self._client.iter_storage(page_size)
+        while True:
+            try:
+                yield self._run(pages.__anext__())
+            except StopAsyncIteration:
+                return
+
+    def delete_storage(self, storage_ids):
+        return self._run(self._client.delete_storage(storage_ids))
+
+    def register(self, name):
+        return self._run(self._client.register(name))
+
+    def close(self):
+        if not self._loop.is_closed():
+            self._run(self._client.close())
+            self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
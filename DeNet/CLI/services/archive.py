@@ -0,0 +1,95 @@
+import bisect
+import os
+import pathlib
+from typing import NamedTuple
+
+
+class ArchiveException(Exception):
+    pass
+
+
+class Member(NamedTuple):
+    """File of the archive and its bytes in the storage content"""
+    name: str
+    offset: int
+    length: int
+
+
+class PackedDirectory:
+    """Files of a directory laid one after another as one byte stream,
+    so many small files share cells instead of getting a storage each.
+    Members are ordered by offset, a cell may hold parts of several files"""
+
+    def __init__(self, root, members):
+        self.root = pathlib.Path(root)
+        self.name = self.root.name
+        self.members = list(members)
+        self._offsets = [member.offset for member in self.members]
+        self.size = self.members[-1].offset + self.members[-1].length if self.members else 0
+
+    @classmethod
+    def scan(cls, root):
+        """Regular files of the directory tree in a stable order. Empty directories are not kept"""
+        root = pathlib.Path(root)
+        members = []
+        offset = 0
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                path = pathlib.Path(dir_path, file_name)
+                if not path.is_file():
+                    continue
+                length = path.stat().st_size
+                members.append(Member(path.relative_to(root).as_posix(), offset, length))
+                offset += length
+        return cls(root, members)
+
+    def get_member_path(self, name):
+        """Path of the member under the root, names from the server are not trusted"""
+        parts = pathlib.PurePosixPath(name).parts
+        if not parts or parts[0] == "/" or ".." in parts or "\\" in name:
+            raise ArchiveException(f"Member name {name} is not a relative path")
+        return self.root.joinpath(*parts)
+
+    def _pieces(self, offset, size):
+        """(member, offset in the member, length) of the members overlapping offset..offset + size"""
+        end = offset + size
+        index = max(bisect.bisect_right(self._offsets, offset) - 1, 0)
+        while index < len(self.members) and self.members[index].offset < end:
+            member = self.members[index]
+            start, stop = max(offset, member.offset), min(end, member.offset + member.length)
+            if stop > start:
+                yield member, start - member.offset, stop - start
+            index += 1
+
+    def read(self, offset, size):
+        """Bytes of the stream at offset, blocking"""
+        chunks = []
+        for member, member_offset, length in self._pieces(offset, size):
+            with open(self.get_member_path(member.name), "rb") as f:
+                f.seek(member_offset)
+                data = f.read(length)
+            if len(data) != length:
+                raise ArchiveException(f"{member.name} was changed during upload")
+            chunks.append(data)
+        return b"".join(chunks)
+
+    def create_files(self):
+        """Creates every member file with its final length before the cells are written"""
+        for member in self.members:
+            path = self.get_member_path(member.name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "wb") as f:
+                f.truncate(member.length)
+
+    def write(self, offset, data):
+        """Scatters bytes of the stream at offset over the member files, blocking"""
+        view = memoryview(data)
+        position = 0
+        for member, member_offset, length in self._pieces(offset, len(data)):
+            fd = os.open(self.get_member_path(member.name), os.O_WRONLY)
+            try:
+                os.pwrite(fd, view[position:position + length], member_offset)
+            finally:
+                os.close(fd)
+            position += length
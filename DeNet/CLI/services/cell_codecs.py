@@ -0,0 +1,74 @@
+import asyncio
+import hashlib
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional
+    zstandard = None
+
+CODECS = ("none", "zlib", "zstd")
+
+
+class CodecException(Exception):
+    pass
+
+
+def compress(name: str, data: bytes) -> bytes:
+    if name == "zlib":
+        return zlib.compress(data)
+    if name == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def compress_with_digest(name: str, data: bytes) -> tuple[bytes, str]:
+    """Compressed cell and sha256 of it, one job of the pool"""
+    data = compress(name, data)
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def decompress(name: str, data: bytes) -> bytes:
+    if name == "zlib":
+        return zlib.decompress(data)
+    if name == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class Codec:
+    """Compresses and decompresses cells in a process pool so the event loop is never blocked"""
+
+    def __init__(self, name="none", workers=None):
+        if name not in CODECS:
+            raise CodecException(f"Unknown codec {name}")
+        if name == "zstd" and zstandard is None:
+            raise CodecException("zstd codec needs the zstandard package: pip install zstandard")
+        self.name = name
+        self._pool = ProcessPoolExecutor(workers) if name != "none" else None
+
+    async def compress(self, data: bytes) -> bytes:
+        if self._pool is None:
+            return data
+        return await asyncio.get_running_loop().run_in_executor(self._pool, compress, self.name, data)
+
+    async def compress_with_digest(self, data: bytes) -> tuple[bytes, str]:
+        if self._pool is None:
+            return await asyncio.to_thread(compress_with_digest, self.name, data)
+        return await asyncio.get_running_loop().run_in_executor(self._pool, compress_with_digest, self.name, data)
+
+    async def decompress(self, data: bytes) -> bytes:
+        if self._pool is None:
+            return data
+        return await asyncio.get_running_loop().run_in_executor(self._pool, decompress, self.name, data)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
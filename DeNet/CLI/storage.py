@@ -4,7 +4,11 @@ import sys
 import click
 from dotenv import dotenv_values
 
-from services.api_client import APIClient, APIClientException
+from services.api_client import (
+    APIClient, APIClientException, UPLOAD_WINDOW, UPLOAD_MAX_MEMORY, UPLOAD_RETRIES, DOWNLOAD_PARTS,
+    CELL_SIZE_MIN, CELL_SIZE_MAX, STORAGE_PAGE, STORAGE_PAGE_MAX
+)
+from services.cell_codecs import CODECS
 
 config = dotenv_values(".env")
 
@@ -29,57 +33,119 @@ def cli(api_key:str, server:str):
 
 
 @click.command()
-def ls():
+@click.option('--page-size', help='Storages requested at once, next pages are fetched while printing',
+              default=STORAGE_PAGE, show_default=True, type=click.IntRange(min=1, max=STORAGE_PAGE_MAX))
+def ls(page_size: int):
     """ Show storage list """
     click.echo(f'List of your storage in server {SERVER}')
     client = APIClient(server=SERVER, api_key=API_KEY)
+    number = 0
     try:
-        storage_list = client.storage_list().get("storage_list")
+        for number, storage in enumerate(client.iter_storage(page_size), start=1):
+            file_name = storage.get("name")
+            pk = storage.get("id")
+            click.echo(f"{number}) ID={pk}, {file_name=} ")
     except APIClientException as err:
         click.echo(f"Couldn't connect to server {repr(err)}")
         time.sleep(2)
         sys.exit(1)
-    if storage_list:
-        for number, storage in enumerate(storage_list):
-            file_name = storage.get("name")
-            pk = storage.get("id")
-            click.echo(f"{number + 1}) ID={pk}, {file_name=} ")
-    else:
+    finally:
+        client.close()
+    if not number:
         click.echo(f"You haven't had any storage yet ")
 
 
 @click.command()
 @click.option('--path', help='Path for save', default=".", type=click.Path(file_okay=False))
+@click.option('--direct/--compose', help='Write cells straight into the output file or compose it from temp files',
+              default=True, show_default=True)
+@click.option('--whole', help='Download the whole file by Range requests instead of cell by cell', is_flag=True)
+@click.option('--parts', help='Parallel ranges for --whole', default=DOWNLOAD_PARTS, show_default=True,
+              type=click.IntRange(min=1))
 @click.argument("storage_id")
-def download(path:str, storage_id: int):
-    """ Download file from storage by ID"""
+def download(path:str, direct:bool, whole:bool, parts:int, storage_id: int):
+    """ Download file from storage by ID, a directory is extracted into PATH"""
     click.echo(f'{path=}')
     click.echo(f'Download file by ID={storage_id} in server {SERVER}')
     client = APIClient(server=SERVER, api_key=API_KEY)
     try:
-        download = client.download(storage_id, path)
+        if whole:
+            download = client.download_whole(storage_id, path, parts=parts)
+        else:
+            download = client.download(storage_id, path, direct=direct)
     except APIClientException as err:
         click.echo(f"Couldn't connect to server {repr(err)}")
         time.sleep(2)
         sys.exit(1)
+    finally:
+        client.close()
     click.echo(f'File was downloaded')
 
 
 @click.command()
-@click.argument('file', type=click.Path(exists=True, dir_okay=False))
-def upload(file:str):
-    """ Upload file to storage """
+@click.option('--window', help='Max number of cells in flight', default=UPLOAD_WINDOW, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--max-memory', help='Max memory for cells in flight (MiB)', default=UPLOAD_MAX_MEMORY // 1024 // 1024,
+              show_default=True, type=click.IntRange(min=1))
+@click.option('--raw/--multipart', help='Send cells as raw body or as multipart form', default=True,
+              show_default=True)
+@click.option('--dedup/--no-dedup', help="Skip cells the server already has (raw mode only)", default=True,
+              show_default=True)
+@click.option('--resume', help='Upload session to resume, only missing cells are sent', default=None)
+@click.option('--retries', help='Retries per cell', default=UPLOAD_RETRIES, show_default=True,
+              type=click.IntRange(min=0))
+@click.option('--packed', help='Keep all cells in one preallocated data file on the server', is_flag=True)
+@click.option('--cell-size', help='Fixed cell size (KiB), chosen adaptively by default', default=None,
+              type=click.IntRange(min=1))
+@click.option('--min-cell-size', help='Min adaptive cell size (KiB)', default=CELL_SIZE_MIN // 1024,
+              show_default=True, type=click.IntRange(min=1))
+@click.option('--max-cell-size', help='Max adaptive cell size (KiB)', default=CELL_SIZE_MAX // 1024,
+              show_default=True, type=click.IntRange(min=1))
+@click.option('--link-speed', help='Upload link speed (MiB/s) to limit the adaptive cell size', default=None,
+              type=click.FloatRange(min=0, min_open=True))
+@click.option('--codec', help='Compress cells before upload', default="none", show_default=True,
+              type=click.Choice(CODECS))
+@click.argument('file', type=click.Path(exists=True))
+def upload(file:str, window:int, max_memory:int, raw:bool, dedup:bool, resume:str, retries:int, packed:bool,
+           cell_size:int, min_cell_size:int, max_cell_size:int, link_speed:float, codec:str):
+    """ Upload file or directory (recursively, small files share cells) to storage """
     click.echo(f'Upload file {file} to server')
-    client = APIClient(server=SERVER, api_key=API_KEY)
+    client = APIClient(server=SERVER, api_key=API_KEY, retries=retries)
     try:
-        upload = client.upload_file(file)
+        upload = client.upload_file(file, window=window, max_memory=max_memory * 1024 * 1024, raw=raw,
+                                    dedup=dedup, resume=resume, packed=packed,
+                                    cell_size=cell_size * 1024 if cell_size else None,
+                                    link_speed=link_speed * 1024 * 1024 if link_speed else None,
+                                    min_cell_size=min_cell_size * 1024, max_cell_size=max_cell_size * 1024,
+                                    codec=codec)
     except APIClientException as err:
         click.echo(f"Couldn't connect to server {repr(err)}")
         time.sleep(2)
         sys.exit(1)
+    finally:
+        client.close()
     click.echo(f'File was uploaded')
 
 
+@click.command()
+@click.argument('storage_ids', nargs=-1, required=True, type=int)
+def rm(storage_ids: tuple[int]):
+    """ Delete storages by ID """
+    client = APIClient(server=SERVER, api_key=API_KEY)
+    try:
+        deleted = client.delete_storage(list(storage_ids))
+    except APIClientException as err:
+        click.echo(f"Couldn't connect to server {repr(err)}")
+        time.sleep(2)
+        sys.exit(1)
+    finally:
+        client.close()
+    for pk in deleted:
+        click.echo(f"Storage ID={pk} was deleted")
+    for pk in sorted(set(storage_ids) - set(deleted)):
+        click.echo(f"Storage ID={pk} was not found")
+
+
 @click.command()
 @click.argument('name', type=str)
 def register(name:str):
@@ -98,6 +164,7 @@ def register(name:str):
 cli.add_command(ls)
 cli.add_command(download)
 cli.add_command(upload)
+cli.add_command(rm)
 
 
 if __name__ == '__main__':
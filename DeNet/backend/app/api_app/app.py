@@ -1,18 +1,32 @@
 from contextlib import asynccontextmanager
 
 from typing import Annotated
+from pathlib import PurePosixPath
+from urllib.parse import quote
 import uuid
 
-from fastapi import FastAPI, File, Request, UploadFile, status, Header, Body
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, status, Header, HTTPException, Query
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse, Response
 from . import schemas
 
 
 from ..db import database, models, db_utils
-from ..db.models import Storage, Cell
-from ..settings import DEBUG
-from .app_depends import Session, Media_path, User
-from ..services.file_service import write_to_storage
+from ..db.models import Storage
+from ..settings import DEBUG, CELL_SIZE, SWEEPER_ENABLED, STORAGE_MAX_BYTES
+from .app_depends import Session, Storage_roots, User, Upload_storage
+from ..services.file_service import (
+    write_to_temp, place_temp_file, get_cell_path, get_blob_path, write_blob_to_temp,
+    get_cells_length, parse_range, read_cells, get_data_path, allocate_data_file, write_stream_at,
+    iter_upload_file, get_path_template, get_cell_limit
+)
+from ..services.metrics_service import MetricsMiddleware, render_metrics
+from ..services.batch_service import cell_batcher
+from ..services.auth_service import UploadStorage, upload_session_cache
+from ..services.root_service import StorageRoots
+from ..services.sweep_service import Sweeper
+from ..services.removal_service import delete_storages, file_remover
+from ..services.disk_service import disk_io
 
 
 @asynccontextmanager
@@ -20,13 +34,24 @@ async def database_init(app: FastAPI):
     engine = database.get_engine()
     async with engine.begin() as conn:
         await conn.run_sync(models.Base.metadata.create_all)
+    disk_io.start()
+    cell_batcher.start(database.get_db_session())
+    file_remover.start(database.get_db_session())
+    sweeper = Sweeper(database.get_db_session(), file_remover)
+    if SWEEPER_ENABLED:
+        sweeper.start()
     yield
+    await sweeper.stop()
+    await file_remover.stop()
+    await cell_batcher.stop()
+    await disk_io.stop()
     await engine.dispose()
 
 
 app = FastAPI(
     debug=DEBUG, lifespan=database_init
 )
+app.add_middleware(MetricsMiddleware)
 
 
 """
@@ -43,6 +68,22 @@ async def http_instance_not_exist_exception_handler(request, exc):
     return JSONResponse(answer.model_dump(), status.HTTP_404_NOT_FOUND)
 
 
+@app.exception_handler(db_utils.InstanceAlreadyExists)
+async def http_instance_already_exists_exception_handler(request, exc):
+    answer = schemas.Error(
+        result=False, error_type=exc.__class__.__name__, error_message=str(exc)
+    )
+    return JSONResponse(answer.model_dump(), status.HTTP_409_CONFLICT)
+
+
+@app.exception_handler(db_utils.CellTooLarge)
+async def http_cell_too_large_exception_handler(request, exc):
+    answer = schemas.Error(
+        result=False, error_type=exc.__class__.__name__, error_message=str(exc)
+    )
+    return JSONResponse(answer.model_dump(), status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+
 @app.exception_handler(db_utils.CRUDException)
 async def http_crud_exception_handler(request, exc):
     answer = schemas.Error(
@@ -52,6 +93,13 @@ async def http_crud_exception_handler(request, exc):
 
 
 
+@app.get('/metrics', include_in_schema=False)
+async def get_metrics() -> Response:
+    """Prometheus scrape endpoint, is not proxied by nginx"""
+    content, content_type = render_metrics()
+    return Response(content, media_type=content_type)
+
+
 # if DEBUG:
 #     @app.get('/api/hello',
 #              )
@@ -61,21 +109,210 @@ async def http_crud_exception_handler(request, exc):
 #         return answer
 
 
+NDJSON = "application/x-ndjson"
+
+
+async def iter_storage_ndjson(user, limit: int, after: int | None):
+    """Yields the storage list as NDJSON lines fetching it page by page.
+    The request session is closed before the body is streamed, so the generator opens its own"""
+    async with database.get_db_session()() as orm_session:
+        while True:
+            page = (await db_utils.get_user_storage(user, orm_session, limit, after)).all()
+            for storage in page:
+                yield schemas.StorageBaseOut.model_validate(storage).model_dump_json() + "\n"
+            if len(page) < limit:
+                break
+            after = page[-1].id
+
+
+def check_address(storage: UploadStorage, address: int) -> None:
+    if not 0 <= address < storage.size:
+        raise db_utils.CRUDException(f"Address {address} is out of storage")
+
+
+def check_members(storage: UploadStorage, members: schemas.Members_in) -> None:
+    """Members must be relative paths inside the archive and lie within the storage content"""
+    if not storage.archive:
+        raise db_utils.CRUDException("Storage is not an archive")
+    limit = storage.size * storage.cell_size
+    for member in members.members:
+        name = PurePosixPath(member.name)
+        if name.is_absolute() or ".." in name.parts or "\\" in member.name:
+            raise db_utils.CRUDException(f"Member name {member.name} is not a relative path")
+        if member.offset + member.length > limit:
+            raise db_utils.CRUDException(f"Member {member.name} is out of storage")
+
+
+# (storage id, address) of the cells being written by this process
+cell_writes: set[tuple[int, int]] = set()
+
+
+@asynccontextmanager
+async def claim_cell(storage: UploadStorage, address: int, orm_session):
+    """Rejects a cell which is already committed or is being written by this process,
+    so a duplicate upload can't overwrite the file of a committed cell.
+    The request session is closed, the body may take long to arrive and the connection is not held meanwhile"""
+    key = (storage.id, address)
+    if key in cell_writes:
+        raise db_utils.InstanceAlreadyExists(f"Cell {address} of storage {storage.id} is being uploaded")
+    cell_writes.add(key)
+    try:
+        if await db_utils.cell_exists(storage.id, address, orm_session):
+            raise db_utils.InstanceAlreadyExists(f"Cell {address} of storage {storage.id} already exists")
+        await orm_session.close()
+        yield
+    finally:
+        cell_writes.discard(key)
+
+
+async def save_cell(user, storage: UploadStorage, address: int, stream, roots: StorageRoots,
+                    orm_session) -> None:
+    """Writes the cell to a temporary file on the root chosen for this cell and moves it to the cell path
+    before the cell row is committed. If the row is not committed the address stays missing
+    and the retry replaces the file. The cell is acknowledged once its row is committed"""
+    async with claim_cell(storage, address, orm_session):
+        path = get_cell_path(user, storage, address)
+        root = roots.choose_root(f"{storage.id}/{address}")
+        storage_path = roots.get_root_path(root)
+        temp_path, digest = await write_to_temp(
+            stream, storage_path, path, get_cell_limit(storage.cell_size, storage.codec)
+        )
+        place_temp_file(temp_path, storage_path, path)
+        await disk_io.sync_directory(temp_path.parent)
+        await cell_batcher.add(path=str(path), address=address, storage_id=storage.id, digest=digest, root=root)
+
+
+async def save_packed_cell(user, storage: UploadStorage, address: int, stream, roots: StorageRoots,
+                           orm_session) -> None:
+    """Writes the cell into the data file of the packed storage at address * cell_size.
+    The bytes are written in place, so a cell which is already committed or is being written
+    is rejected before they reach the data file"""
+    async with claim_cell(storage, address, orm_session):
+        path = get_data_path(user, storage.id)
+        offset = address * storage.cell_size
+        length, digest = await write_stream_at(
+            stream, roots.get_root_path(storage.root), path, offset, storage.cell_size
+        )
+        await cell_batcher.add(
+            path=str(path), address=address, storage_id=storage.id, offset=offset, length=length, digest=digest,
+            root=storage.root,
+        )
+
+
+async def save_blob_cell(user, storage: UploadStorage, address: int, stream, roots: StorageRoots,
+                         digest: str) -> None:
+    """Writes the content-addressed cell only if no root has the blob yet.
+    The blob is looked up again and its cell is committed under the lock of the blob path,
+    so the background removal of unreferenced blobs can't unlink a blob the new cell refers to"""
+    path = get_blob_path(user, digest)
+    temp_path = None
+    if roots.find_root(path) is None:
+        root = roots.choose_root(digest)
+        temp_path = await write_blob_to_temp(
+            stream, roots.get_root_path(root), path, digest, get_cell_limit(storage.cell_size, storage.codec)
+        )
+    try:
+        async with database.get_db_session()() as orm_session:
+            await db_utils.lock_path(str(path), orm_session)
+            existing_root = roots.find_root(path)
+            if existing_root is not None:
+                root = existing_root
+            elif temp_path is None:
+                # the blob was removed after the client had been told it is known
+                raise db_utils.CRUDException("Cell content does not match its digest")
+            else:
+                place_temp_file(temp_path, roots.get_root_path(root), path)
+                await disk_io.sync_directory(temp_path.parent)
+                temp_path = None
+            await cell_batcher.add(path=str(path), address=address, storage_id=storage.id, digest=digest, root=root)
+    finally:
+        if temp_path is not None:
+            temp_path.unlink(missing_ok=True)
+
+
+async def remove_storages(storage_ids: list[int], user, orm_session) -> list[int]:
+    """Deletes the user storages from the list, returns ids of the deleted ones.
+    Their files are removed in the background after the response"""
+    removal = await delete_storages(storage_ids, orm_session, user_id=user.id)
+    await orm_session.commit()
+    for storage_id, _ in removal.storages:
+        upload_session_cache.invalidate_storage(storage_id)
+    file_remover.schedule(removal)
+    return [storage_id for storage_id, _ in removal.storages]
+
+
 @app.get('/download/{file_path:path}',
          tags=["DOWNLOAD"],
          )
-async def redirect_file(request: Request, file_path:str, user: User, session_orm: Session) :
+async def redirect_file(request: Request, file_path:str, user: User, session_orm: Session,
+                        roots: Storage_roots) :
     host = request.client.host
-    cell = await db_utils.get_one(Cell, session_orm, path=file_path)
-    if cell.storage.user_id == user.id:
+    owner_id, root = await db_utils.get_cell_owner(file_path, session_orm)
+    if owner_id == user.id:
+        accel_path = roots.get_accel_path(root, file_path)
         return RedirectResponse(
-            url=f"http://{host}/storage/{file_path}", status_code=status.HTTP_302_FOUND,
-            headers={"X-Accel-Redirect": f"/storage/{file_path}"}
+            url=f"http://{host}{accel_path}", status_code=status.HTTP_302_FOUND,
+            headers={"X-Accel-Redirect": accel_path}
         )
     else:
         raise db_utils.CRUDException("You don't have access")
 
 
+@app.get('/files/{storage_id}',
+         tags=["DOWNLOAD"],
+         response_class=StreamingResponse,
+         )
+async def get_file(storage_id: int, user: User, orm_session: Session, roots: Storage_roots,
+                   range: Annotated[str | None, Header()] = None):
+    """Endpoint for download the whole file of the storage in one response, supports Range requests.
+    Only the cells of the requested range are fetched"""
+    storage = await db_utils.get_by_id(Storage, storage_id, orm_session)
+    if storage.user_id != user.id:
+        raise db_utils.CRUDException("You don't have access")
+    if not storage.completed:
+        raise db_utils.InstanceNotExists("Storage is not uploaded completely")
+    if storage.codec != models.CODEC_NONE:
+        raise db_utils.CRUDException("Compressed storage can be downloaded only cell by cell")
+    total = 0
+    if storage.size:
+        # every cell but the last one is cell_size bytes
+        last = (await db_utils.get_storage_cells(storage.id, storage.size - 1, storage.size - 1, orm_session)).one()
+        if storage.layout == models.LAYOUT_PACKED:
+            total = storage.cell_size * (storage.size - 1) + last.length
+        else:
+            total = get_cells_length(roots.get_file_path(last.root, last.path), storage.size, storage.cell_size)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(storage.name)}",
+    }
+    try:
+        byte_range = parse_range(range, total)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={**headers, "Content-Range": f"bytes */{total}"},
+        )
+    if byte_range is None:
+        start, end, status_code = 0, total - 1, status.HTTP_200_OK
+    else:
+        start, end = byte_range
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+    headers["Content-Length"] = str(end - start + 1)
+    parts = []
+    if start <= end:
+        first = start // storage.cell_size
+        cells = await db_utils.get_storage_cells(storage.id, first, end // storage.cell_size, orm_session)
+        parts = [(roots.get_file_path(cell.root, cell.path), cell.offset or 0) for cell in cells]
+        start, end = start - first * storage.cell_size, end - first * storage.cell_size
+    return StreamingResponse(
+        read_cells(parts, storage.cell_size, start, end),
+        status_code=status_code,
+        headers=headers,
+        media_type="application/octet-stream",
+    )
+
+
 @app.get('/storage',
          response_model=schemas.StorageList,
          tags=["STORAGE"],
@@ -83,13 +320,46 @@ async def redirect_file(request: Request, file_path:str, user: User, session_orm
          )
 async def get_storage_list(user: User,
                        orm_session: Session,
+                       limit: Annotated[int, Query(ge=1, le=schemas.STORAGE_PAGE_MAX)] = schemas.STORAGE_PAGE,
+                       after: int | None = None,
+                       accept: Annotated[str | None, Header()] = None,
                        ) -> schemas.StorageList:
-    storage_list = await db_utils.get_user_storage(user, orm_session)
+    """Endpoint for the storage list, newest first, by pages of limit storages.
+    With "Accept: application/x-ndjson" the whole list after the cursor is streamed one storage per line"""
+    if accept == NDJSON:
+        return StreamingResponse(iter_storage_ndjson(user, limit, after), media_type=NDJSON)
+    storage_list = (await db_utils.get_user_storage(user, orm_session, limit, after)).all()
 
     answer_schema = [
-        schemas.StorageBaseOut.model_validate(storage) for storage in storage_list.unique()
+        schemas.StorageBaseOut.model_validate(storage) for storage in storage_list
     ]
-    return schemas.StorageList(storage_list = answer_schema)
+    next_page = storage_list[-1].id if len(storage_list) == limit else None
+    return schemas.StorageList(storage_list = answer_schema, next=next_page)
+
+
+@app.delete('/storage/{storage_id}',
+            response_model=schemas.Storage_delete_out,
+            tags=["STORAGE"],
+            status_code=status.HTTP_200_OK,
+            )
+async def delete_storage(storage_id: int, user: User, orm_session: Session) -> schemas.Storage_delete_out:
+    """Endpoint for delete the storage with all its cells"""
+    deleted = await remove_storages([storage_id], user, orm_session)
+    if not deleted:
+        raise db_utils.InstanceNotExists(f"Storage does not exists with id = {storage_id}")
+    return schemas.Storage_delete_out(result=True, deleted=deleted)
+
+
+@app.delete('/storage',
+            response_model=schemas.Storage_delete_out,
+            tags=["STORAGE"],
+            status_code=status.HTTP_200_OK,
+            )
+async def delete_storage_list(storage: schemas.Storage_delete_in, user: User,
+                              orm_session: Session) -> schemas.Storage_delete_out:
+    """Endpoint for delete several storages at once, ids of missing or foreign storages are skipped"""
+    deleted = await remove_storages(storage.ids, user, orm_session)
+    return schemas.Storage_delete_out(result=True, deleted=deleted)
 
 
 @app.get('/download_init',
@@ -102,16 +372,48 @@ async def get_storage(user: User,
                       storage: schemas.StorageBase
                        ) -> schemas.StorageOut:
 
-    storage = await db_utils.get_by_id(Storage, storage.id, orm_session)
+    storage = await db_utils.get_storage_with_cells(storage.id, orm_session)
     if storage.user_id != user.id:
         raise db_utils.CRUDException("You don't have access")
-    cells = [
-        schemas.CellBase.model_validate(cell) for cell in storage.cells
-    ]
     answer = schemas.StorageOut.model_validate(storage)
     return answer
 
 
+@app.get('/manifest/{storage_id}',
+         response_model=schemas.Manifest_out,
+         tags=["DOWNLOAD"],
+         status_code=status.HTTP_200_OK,
+         )
+async def get_manifest(storage_id: int,
+                       user: User,
+                       orm_session: Session,
+                       limit: Annotated[int, Query(ge=1, le=schemas.MANIFEST_PAGE_MAX)] = schemas.MANIFEST_PAGE,
+                       after: int | None = None,
+                       ) -> schemas.Manifest_out:
+    """Endpoint for the compact download manifest: storage info and a page of cells by columns,
+    ordered by address. Paths are replaced by one template when all cells of the page follow it,
+    offsets of packed cells are address * cell_size"""
+    storage = await db_utils.get_by_id(Storage, storage_id, orm_session)
+    if storage.user_id != user.id:
+        raise db_utils.CRUDException("You don't have access")
+    cells = (await db_utils.get_storage_cells_page(storage_id, orm_session, limit, after)).all()
+    addresses = [cell.address for cell in cells]
+    paths = [cell.path for cell in cells]
+    path_template = get_path_template(addresses, paths)
+    manifest_cells = schemas.ManifestCells(
+        address=addresses,
+        path=None if path_template else paths,
+        digest=[cell.digest for cell in cells],
+        length=[cell.length for cell in cells] if storage.layout == models.LAYOUT_PACKED else None,
+    )
+    return schemas.Manifest_out(
+        id=storage.id, name=storage.name, size=storage.size, layout=storage.layout,
+        cell_size=storage.cell_size, codec=storage.codec, archive=storage.archive, path_template=path_template,
+        cells=manifest_cells,
+        next=addresses[-1] if len(cells) == limit else None,
+    )
+
+
 @app.post(
     "/upload_init",
     response_model=schemas.Upload_init_out,
@@ -124,19 +426,115 @@ async def post_init_upload(
     storage: schemas.Upload_init_in,
     orm_session: Session,
     user: User,
-    static_path: Media_path,
+    roots: Storage_roots,
 ) -> schemas.Upload_init_out:
     """Endpoint for create an storage"""
     # path = await write_to_disk(user, file, static_path)
-    new_storage = models.Storage(user=user, name=storage.name, size=storage.size)
-    pk = await db_utils.save(new_storage, orm_session)
+    cell_size = storage.cell_size or CELL_SIZE
+    if storage.size * cell_size > STORAGE_MAX_BYTES:
+        raise db_utils.CRUDException(f"Storage can't be bigger than {STORAGE_MAX_BYTES} bytes")
+    if storage.layout == models.LAYOUT_PACKED and storage.codec != models.CODEC_NONE:
+        # compressed cells have no fixed size to be placed at fixed offsets
+        raise db_utils.CRUDException("Packed storage does not support compression")
+    root = 0
+    if storage.layout == models.LAYOUT_PACKED:
+        # the data file can't be split, the whole storage goes to one root
+        root = roots.choose_root(f"{user.id}/{uuid.uuid4()}")
+    new_storage = models.Storage(
+        user_id=user.id, name=storage.name, size=storage.size, layout=storage.layout, cell_size=cell_size,
+        codec=storage.codec, root=root, archive=storage.archive, completed=storage.size == 0,
+    )
+    # the storage and its session are committed together and only after the data file is allocated,
+    # a failed request leaves neither a storage without a session nor a data file without a storage
+    orm_session.add(new_storage)
+    await orm_session.flush((new_storage,))
+    pk = new_storage.id
     uuid_session = uuid.uuid4()
-    new_session = models.UploadSession(storage_id=pk, session=uuid_session)
-    orm_session.add(new_session)
-    # await session.flush((new_session, ))
-    # session_id = new_session.session
+    orm_session.add(models.UploadSession(storage_id=pk, session=uuid_session))
+    data_path = get_data_path(user, pk)
+    try:
+        if storage.layout == models.LAYOUT_PACKED:
+            try:
+                await allocate_data_file(roots.get_root_path(root), data_path, storage.size * cell_size)
+            except OSError as err:
+                raise HTTPException(
+                    status_code=status.HTTP_507_INSUFFICIENT_STORAGE, detail=f"Couldn't allocate the storage: {err}"
+                )
+        await orm_session.commit()
+    except BaseException:
+        await orm_session.rollback()
+        if storage.layout == models.LAYOUT_PACKED:
+            roots.remove(root, data_path)
+        raise
+    return schemas.Upload_init_out(result=True, pk=pk, session=str(uuid_session), cell_size=cell_size)
+
+
+@app.get(
+    "/upload_status",
+    response_model=schemas.Upload_status_out,
+    tags=["UPLOAD"],
+    status_code=status.HTTP_200_OK,
+)
+async def get_upload_status(
+    orm_session: Session,
+    storage: Upload_storage,
+) -> schemas.Upload_status_out:
+    """Endpoint for check which cells of the upload session are still missing"""
+    uploaded = set(await db_utils.get_storage_addresses(storage.id, orm_session))
+    missing = [address for address in range(storage.size) if address not in uploaded]
+    return schemas.Upload_status_out(
+        pk=storage.id, size=storage.size, cell_size=storage.cell_size, codec=storage.codec, layout=storage.layout,
+        archive=storage.archive, missing=missing,
+    )
+
+
+@app.post(
+    "/members",
+    response_model=schemas.Upload_out,
+    tags=["UPLOAD"],
+    status_code=status.HTTP_201_CREATED,
+)
+async def post_members(
+    members: schemas.Members_in,
+    orm_session: Session,
+    storage: Upload_storage,
+) -> schemas.Upload_out:
+    """Endpoint for upload a page of the archive index: files of the directory with their
+    place in the storage content. Members already stored at these positions are kept,
+    so a page may be sent again when the upload is resumed"""
+    check_members(storage, members)
+    rows = [
+        dict(storage_id=storage.id, position=members.start + index, name=member.name,
+             offset=member.offset, length=member.length)
+        for index, member in enumerate(members.members)
+    ]
+    await db_utils.insert_many(models.Member, orm_session, rows, "position")
     await orm_session.commit()
-    return schemas.Upload_init_out(result=True, pk=pk, session=str(uuid_session))
+    return schemas.Upload_out(result=True)
+
+
+@app.get(
+    "/members/{storage_id}",
+    response_model=schemas.Members_out,
+    tags=["DOWNLOAD"],
+    status_code=status.HTTP_200_OK,
+)
+async def get_members(
+    storage_id: int,
+    user: User,
+    orm_session: Session,
+    limit: Annotated[int, Query(ge=1, le=schemas.MEMBERS_PAGE_MAX)] = schemas.MEMBERS_PAGE,
+    after: int | None = None,
+) -> schemas.Members_out:
+    """Endpoint for the archive index by pages of limit files ordered by position"""
+    storage = await db_utils.get_by_id(Storage, storage_id, orm_session)
+    if storage.user_id != user.id:
+        raise db_utils.CRUDException("You don't have access")
+    members = (await db_utils.get_members_page(storage_id, orm_session, limit, after)).all()
+    return schemas.Members_out(
+        members=[schemas.MemberBase.model_validate(member) for member in members],
+        next=members[-1].position if len(members) == limit else None,
+    )
 
 
 @app.post(
@@ -152,15 +550,13 @@ async def post_register(
     orm_session: Session,
 ) -> schemas.RegisterOut:
     """Endpoint for create a user"""
-    # path = await write_to_disk(user, file, static_path)
+    # the unique api_key decides, concurrent registrations with one key don't both pass a check
     try:
-        user = await db_utils.get_one(models.User, orm_session, api_key=register.api_key)
-        if user:
-            raise db_utils.CRUDException("User has already exist")
-    except db_utils.InstanceNotExists:
-        new_user = models.User(name=register.name, api_key=register.api_key)
-        pk = await db_utils.save(new_user, orm_session)
-        return schemas.RegisterOut(result=True)
+        await db_utils.insert_or_fail(models.User, orm_session, name=register.name, api_key=register.api_key)
+    except db_utils.InstanceAlreadyExists:
+        raise db_utils.CRUDException("User has already exist")
+    await orm_session.commit()
+    return schemas.RegisterOut(result=True)
 
 
 
@@ -169,29 +565,84 @@ async def post_register(
     response_model=schemas.Upload_out,
     tags=["UPLOAD"],
     status_code=status.HTTP_201_CREATED,
+    openapi_extra=schemas.upload_form_openapi,
     # responses=schemas.error_responses,
 )
 async def upload(
     request: Request,
+    user: User,
+    storage: Upload_storage,
+    roots: Storage_roots,
     orm_session: Session,
-    session: Annotated[str, Header(..., )],
-    number: Annotated[int, Body(..., )],
+    address: Annotated[int | None, Header(description="Cell number, checked before the form is read")] = None,
+) -> schemas.Upload_out:
+    """Endpoint for upload file. The form with the file and its number is parsed by hand
+    only after the session, its owner and the address header are checked"""
+    if address is not None:
+        check_address(storage, address)
+    async with request.form(max_files=1, max_fields=1) as form:
+        file, number = form.get("file"), form.get("number")
+        if not isinstance(file, StarletteUploadFile) or not isinstance(number, str) or not number.isdigit():
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Form must have a file and its number"
+            )
+        number = int(number)
+        if address is not None and number != address:
+            raise db_utils.CRUDException("Number does not match the address header")
+        check_address(storage, number)
+        if storage.layout == models.LAYOUT_PACKED:
+            await save_packed_cell(user, storage, number, iter_upload_file(file), roots, orm_session)
+        else:
+            await save_cell(user, storage, number, iter_upload_file(file), roots, orm_session)
+    return schemas.Upload_out(result=True)
+
+@app.put(
+    "/cells/{storage_id}/{address}",
+    response_model=schemas.Upload_out,
+    tags=["UPLOAD"],
+    status_code=status.HTTP_201_CREATED,
+    # responses=schemas.error_responses,
+)
+async def upload_raw(
+    request: Request,
+    storage_id: int,
+    address: int,
     user: User,
-    storage_path: Media_path,
-    file: Annotated[
-        UploadFile, File(..., description="image file", title="FILE")
-    ],
+    storage: Upload_storage,
+    roots: Storage_roots,
+    orm_session: Session,
+    digest: Annotated[str | None, Header(pattern=r"^[0-9a-f]{64}$")] = None,
 ) -> schemas.Upload_out:
-    """Endpoint for upload file"""
-    upload_session = await db_utils.get_one(models.UploadSession, orm_session, session=session)
-    storage: Storage = upload_session.storage
-    cells = storage.cells
-    addresses = [cell.address for cell in cells]
-    if number not in addresses:
-    # cell = await db_utils.get_one(models.Cell, orm_session, address=number, storage_id=storage.id)
-        path = await write_to_storage(user, file, storage_path=storage_path, storage=storage, address=number)
-        memory_cell = models.Cell(path=path, address=number, storage=storage)
-        await db_utils.save(memory_cell, orm_session)
+    """Endpoint for upload cell as raw application/octet-stream body.
+    With a digest header the cell is content-addressed: if the user already has
+    a blob with this sha256 the body is not read and may be empty.
+    The body is read only after the session, its owner and the address are checked"""
+    if storage.id != storage_id:
+        raise db_utils.CRUDException("Upload session does not belong to this storage")
+    check_address(storage, address)
+    if storage.layout == models.LAYOUT_PACKED:
+        if digest is not None:
+            raise db_utils.CRUDException("Packed storage does not support content-addressed cells")
+        await save_packed_cell(user, storage, address, request.stream(), roots, orm_session)
+    elif digest is None:
+        await save_cell(user, storage, address, request.stream(), roots, orm_session)
     else:
-        raise db_utils.CRUDException("this address is already exists")
-    return schemas.Upload_out(result=True)
\ No newline at end of file
+        await save_blob_cell(user, storage, address, request.stream(), roots, digest)
+    return schemas.Upload_out(result=True)
+
+
+@app.post(
+    "/cells/known",
+    response_model=schemas.Digests,
+    tags=["UPLOAD"],
+    status_code=status.HTTP_200_OK,
+)
+async def post_known_cells(
+    digests: schemas.Digests,
+    orm_session: Session,
+    user: User,
+) -> schemas.Digests:
+    """Endpoint for check which cell digests the server already has for the user"""
+    paths = [str(get_blob_path(user, digest)) for digest in digests.digests]
+    known = await db_utils.get_known_blobs(paths, orm_session)
+    return schemas.Digests(digests=known)
@@ -2,10 +2,10 @@ from typing import Annotated
 
 from fastapi import Depends, Header, HTTPException
 
-from ..db import models, db_utils
+from ..db import db_utils
 from ..db.database import AsyncSession, get_db_session
-
-MEDIA_PATH = "storage"
+from ..services.auth_service import UserIdentity, UploadStorage, auth_cache, upload_session_cache
+from ..services.root_service import StorageRoots, storage_roots
 
 
 async def get_session():
@@ -25,21 +25,44 @@ async def get_user(
         str, Header(..., description="api-key for user authentication")
     ],
     session: Annotated[AsyncSession, Depends(get_session)],
-):
-
+) -> UserIdentity:
+    user = auth_cache.get(api_key)
+    if user is not None:
+        return user
     try:
-        user = await db_utils.get_one(models.User, session, api_key=api_key)
+        user = UserIdentity(*await db_utils.get_user_identity(api_key, session))
     except db_utils.CRUDException:
         raise HTTPException(status_code=401, detail="Wrong api-key")
+    auth_cache.set(api_key, user)
     return user
 
 
-async def get_media_path():
-    path = MEDIA_PATH
-    # path = f'{path}'
-    return path
+async def get_upload_storage(
+    session: Annotated[str, Header(..., description="upload session")],
+    user: Annotated[UserIdentity, Depends(get_user)],
+    orm_session: Annotated[AsyncSession, Depends(get_session)],
+) -> UploadStorage:
+    """Storage of the upload session, checked against the user before the request body is read"""
+    storage = upload_session_cache.get(session)
+    if storage is None:
+        orm_storage = await db_utils.get_session_storage(session, orm_session)
+        storage = UploadStorage(
+            orm_storage.id, orm_storage.user_id, orm_storage.name, orm_storage.size, orm_storage.layout,
+            orm_storage.cell_size, orm_storage.codec, orm_storage.root, orm_storage.archive,
+        )
+        upload_session_cache.set(session, storage)
+        # the body may take long to arrive, the connection is not held meanwhile
+        await orm_session.close()
+    if storage.user_id != user.id:
+        raise db_utils.CRUDException("You don't have access")
+    return storage
+
+
+async def get_storage_roots() -> StorageRoots:
+    return storage_roots
 
 
 Session = Annotated[AsyncSession, Depends(get_session)]
-User = Annotated[models.User, Depends(get_user)]
-Media_path = Annotated[str, Depends(get_media_path)]
+User = Annotated[UserIdentity, Depends(get_user)]
+Upload_storage = Annotated[UploadStorage, Depends(get_upload_storage)]
+Storage_roots = Annotated[StorageRoots, Depends(get_storage_roots)]
@@ -1,6 +1,8 @@
-from typing import Annotated, List
+from typing import Annotated, List, Literal
 from fastapi import Body
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+from ..settings import CELL_SIZE_MIN, CELL_SIZE_MAX, STORAGE_MAX_CELLS
 
 
 class Hello(BaseModel):
@@ -8,9 +10,20 @@ class Hello(BaseModel):
 
 
 class Upload_init_in(BaseModel):
-    size: int
-    name: str
-    pass
+    size: int = Field(ge=0, le=STORAGE_MAX_CELLS, description="Number of cells")
+    name: str = Field(min_length=1, max_length=255, pattern=r"^[^/\\\x00]+$",
+                      description="File name without directories")
+    layout: Literal["cells", "packed"] = "cells"
+    cell_size: Annotated[int | None, Field(ge=CELL_SIZE_MIN, le=CELL_SIZE_MAX)] = None
+    codec: Literal["none", "zlib", "zstd"] = "none"
+    archive: bool = Body(False, description="The content is a directory indexed by /members")
+
+    @field_validator("name")
+    @classmethod
+    def check_name(cls, name: str) -> str:
+        if name in (".", ".."):
+            raise ValueError("Name must be a file name")
+        return name
 
 
 class Upload_in(BaseModel):
@@ -23,6 +36,22 @@ class Upload_out(BaseModel):
     result: bool
     pass
 
+
+class Upload_status_out(BaseModel):
+    pk: int
+    size: int
+    cell_size: int
+    codec: str = "none"
+    layout: str = "cells"
+    archive: bool = False
+    missing: List[int] = Body([], description="Addresses which are not uploaded yet")
+
+class Digests(BaseModel):
+    digests: List[Annotated[str, Field(pattern=r"^[0-9a-f]{64}$")]] = Field(
+        ..., max_length=1000, description="sha256 hex digests of cells"
+    )
+
+
 class StorageBase(BaseModel):
     id: int
 
@@ -38,20 +67,108 @@ class StorageBaseOut(BaseModel):
 class CellBase(BaseModel):
     address: int
     path: str
+    offset: int | None = None
+    length: int | None = None
+    digest: str | None = Body(None, description="sha256 of the cell content")
     model_config = ConfigDict(from_attributes=True)
 
 class StorageOut(StorageBaseOut):
+    layout: str = "cells"
+    cell_size: int
+    codec: str = "none"
     cells: List[CellBase] = Body([], description="Memory cells")
     model_config = ConfigDict(from_attributes=True)
 
+class ManifestCells(BaseModel):
+    """Cells of a manifest page by columns, the n-th item of every list belongs to the n-th cell"""
+    address: List[int]
+    path: List[str] | None = Body(None, description="Absent when the page has a path template")
+    digest: List[str | None]
+    length: List[int | None] | None = Body(None, description="Only for packed storages")
+
+
+MANIFEST_PAGE = 10000
+MANIFEST_PAGE_MAX = 100000
+
+
+class Manifest_out(BaseModel):
+    id: int
+    name: str
+    size: int
+    layout: str
+    cell_size: int
+    codec: str
+    archive: bool = False
+    path_template: str | None = Body(None, description='Path of every cell with "{address}" replaced by its address')
+    cells: ManifestCells
+    next: int | None = Body(None, description="Cursor of the next page, pass it as after")
+
+
+# a page of the index is inserted by one statement, 5 parameters per member
+MEMBERS_PAGE = 5000
+MEMBERS_PAGE_MAX = 100000
+
+
+class MemberBase(BaseModel):
+    name: str = Field(min_length=1, description="Relative posix path of the file in the archive")
+    offset: int = Field(ge=0)
+    length: int = Field(ge=0)
+    model_config = ConfigDict(from_attributes=True)
+
+
+class Members_in(BaseModel):
+    start: int = Field(0, ge=0, description="Position of the first member of the page in the archive")
+    members: List[MemberBase] = Field(..., min_length=1, max_length=MEMBERS_PAGE)
+
+
+class Members_out(BaseModel):
+    members: List[MemberBase] = Body([], description="Files of the archive ordered by position")
+    next: int | None = Body(None, description="Cursor of the next page, pass it as after")
+
+
+STORAGE_PAGE = 100
+STORAGE_PAGE_MAX = 1000
+
+
 class StorageList(BaseModel):
     storage_list: List[StorageBaseOut] = Body([], description="User storages")
+    next: int | None = Body(None, description="Cursor of the next page, pass it as after")
+
+
+class Storage_delete_in(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=STORAGE_PAGE_MAX)
+
+
+class Storage_delete_out(BaseModel):
+    result: bool
+    deleted: List[int] = Body([], description="Ids of the deleted storages")
+
+
+# /upload reads its form by hand, this keeps it documented
+upload_form_openapi = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file", "number"],
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "number": {"type": "integer"},
+                    },
+                }
+            }
+        },
+    }
+}
 
 
 class Upload_init_out(BaseModel):
     result: bool
     pk: int
     session: str
+    cell_size: int
 
 
 class Error(BaseModel):
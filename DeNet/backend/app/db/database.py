@@ -1,9 +1,12 @@
 import logging
 from functools import lru_cache
 
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
 
+from ..services.metrics_service import MeteredSession, instrument_engine
+
 
 class Base(DeclarativeBase):
     pass
@@ -15,9 +18,12 @@ def get_database():
         DATABASE_PASSWORD,
         DATABASE_USER,
         DATABASE_URL,
+        DATABASE_DSN,
     )
 
-    if DATABASE and DATABASE_USER and DATABASE_PASSWORD and DATABASE_URL:
+    if DATABASE_DSN:
+        database_connection = DATABASE_DSN
+    elif DATABASE and DATABASE_USER and DATABASE_PASSWORD and DATABASE_URL:
         print(f"postgresql+asyncpg://"
             f"{DATABASE_USER}:{DATABASE_PASSWORD}"
             f"@{DATABASE_URL}:5432/{DATABASE}")
@@ -31,14 +37,25 @@ def get_database():
     return database_connection
 
 
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
 @lru_cache
 def get_engine():
     logging.warning("get_engine_func_start")
-    return create_async_engine(get_database(), echo=False)
+    engine = create_async_engine(get_database(), echo=False)
+    if engine.dialect.name == "sqlite":
+        # ON DELETE CASCADE works in sqlite only with foreign keys switched on
+        event.listen(engine.sync_engine, "connect", _enable_sqlite_foreign_keys)
+    instrument_engine(engine.sync_engine)
+    return engine
 
 
 @lru_cache
 def get_db_session():
     return sessionmaker(
-        get_engine(), expire_on_commit=True, class_=AsyncSession
+        get_engine(), expire_on_commit=True, class_=MeteredSession
     )
@@ -1,8 +1,12 @@
+from datetime import datetime
 from typing import Union, Type
+import uuid
 
-from sqlalchemy import select, ScalarResult
+from sqlalchemy import select, update, delete as sql_delete, func, false, Result
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import MultipleResultsFound
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 from . import models
 
@@ -10,7 +14,8 @@ Model = Union[
     models.User,
     models.Storage,
     models.UploadSession,
-    models.Cell
+    models.Cell,
+    models.Member,
 ]
 ModelType = Type[Model]
 
@@ -21,6 +26,12 @@ class CRUDException(Exception): ...  # noqa E701
 class InstanceNotExists(CRUDException): ...  # noqa E701
 
 
+class InstanceAlreadyExists(CRUDException): ...  # noqa E701
+
+
+class CellTooLarge(CRUDException): ...  # noqa E701
+
+
 async def save(new_instance: Model, session: AsyncSession) -> int:
     """Сохраняет объекта в БД, возвращает id"""
     session.add(new_instance)
@@ -30,6 +41,45 @@ async def save(new_instance: Model, session: AsyncSession) -> int:
     return id
 
 
+async def insert_or_fail(model: ModelType, session: AsyncSession, **values) -> int:
+    """Вставляет строку одним INSERT ... ON CONFLICT DO NOTHING, возвращает id.
+    Если строка нарушает уникальное ограничение вызывает исключение.
+    Транзакция не фиксируется"""
+    dialect = sqlite if session.bind.dialect.name == "sqlite" else postgresql
+    stmt = (
+        dialect.insert(model)
+        .values(**values)
+        .on_conflict_do_nothing()
+        .returning(model.id)
+    )
+    pk = await session.scalar(stmt)
+    if pk is None:
+        raise InstanceAlreadyExists(
+            f"{model.__name__} with "
+            f"{tuple(f'{k} = {v}' for k, v in values.items())} "
+            f"already exists"
+        )
+    return pk
+
+
+async def insert_many(
+    model: ModelType, session: AsyncSession, rows: list[dict], *keys: str
+) -> dict[tuple, int]:
+    """Вставляет строки одним многострочным INSERT ... ON CONFLICT DO NOTHING.
+    Возвращает id вставленных строк по значениям колонок keys, конфликтующие строки пропускаются.
+    Транзакция не фиксируется"""
+    columns = {column for row in rows for column in row}
+    dialect = sqlite if session.bind.dialect.name == "sqlite" else postgresql
+    stmt = (
+        dialect.insert(model)
+        .values([{column: row.get(column) for column in columns} for row in rows])
+        .on_conflict_do_nothing()
+        .returning(model.id, *(getattr(model, key) for key in keys))
+    )
+    result = await session.execute(stmt)
+    return {tuple(row[1:]): row[0] for row in result}
+
+
 async def delete(instance: Model, session: AsyncSession) -> None:
     """Удаляет объект из БД"""
     await session.delete(instance)
@@ -75,9 +125,264 @@ async def get_one(model: ModelType, session_orm: AsyncSession, **kwargs) -> Mode
     return one_instance
 
 
+async def get_user_identity(
+    api_key: str, session: AsyncSession
+):
+    """Получает id и имя пользователя по api-key (по индексу)"""
+    stmt = select(models.User.id, models.User.name).where(models.User.api_key == api_key)
+    row = (await session.execute(stmt)).one_or_none()
+    if row is None:
+        raise InstanceNotExists("User does not exists with this api-key")
+    return row
+
+
 async def get_user_storage(
-    user: models.User, session: AsyncSession
-) -> ScalarResult[models.Storage]:
-    """Получает список хранилища пользователя"""
-    stmt = select(models.Storage).filter(models.Storage.user_id == user.id).order_by(models.Storage.id.desc())
-    return await session.scalars(stmt)
+    user: models.User, session: AsyncSession, limit: int, after: int | None = None
+) -> Result:
+    """Получает страницу списка хранилищ пользователя (только id, name, size).
+    Страницы идут по убыванию id, after - id последнего хранилища предыдущей страницы"""
+    stmt = select(models.Storage.id, models.Storage.name, models.Storage.size).filter(
+        models.Storage.user_id == user.id
+    )
+    if after is not None:
+        stmt = stmt.filter(models.Storage.id < after)
+    stmt = stmt.order_by(models.Storage.id.desc()).limit(limit)
+    return await session.execute(stmt)
+
+
+async def get_storage_with_cells(
+    storage_id: int, session: AsyncSession
+) -> models.Storage:
+    """Получает хранилище вместе с ячейками вторым запросом,
+    у ячеек загружаются только address, path, offset, length, digest и root"""
+    return await get_by_id(
+        models.Storage, storage_id, session,
+        options=[
+            selectinload(models.Storage.cells).load_only(
+                models.Cell.address, models.Cell.path, models.Cell.offset, models.Cell.length,
+                models.Cell.digest, models.Cell.root,
+            )
+        ],
+    )
+
+
+async def get_storage_cells_page(
+    storage_id: int, session: AsyncSession, limit: int, after: int | None = None
+) -> Result:
+    """Получает страницу ячеек хранилища (address, path, digest, length) по возрастанию address,
+    after - последний address предыдущей страницы"""
+    stmt = select(models.Cell.address, models.Cell.path, models.Cell.digest, models.Cell.length).filter(
+        models.Cell.storage_id == storage_id
+    )
+    if after is not None:
+        stmt = stmt.filter(models.Cell.address > after)
+    stmt = stmt.order_by(models.Cell.address).limit(limit)
+    return await session.execute(stmt)
+
+
+async def get_storage_cells(
+    storage_id: int, first: int, last: int, session: AsyncSession
+) -> Result:
+    """Получает ячейки хранилища с адресами от first до last включительно
+    (address, path, root, offset, length) по возрастанию address"""
+    stmt = (
+        select(models.Cell.address, models.Cell.path, models.Cell.root, models.Cell.offset, models.Cell.length)
+        .where(models.Cell.storage_id == storage_id, models.Cell.address.between(first, last))
+        .order_by(models.Cell.address)
+    )
+    return await session.execute(stmt)
+
+
+async def get_members_page(
+    storage_id: int, session: AsyncSession, limit: int, after: int | None = None
+) -> Result:
+    """Получает страницу индекса файлов архива (position, name, offset, length) по возрастанию position,
+    after - последний position предыдущей страницы"""
+    stmt = select(models.Member.position, models.Member.name, models.Member.offset, models.Member.length).filter(
+        models.Member.storage_id == storage_id
+    )
+    if after is not None:
+        stmt = stmt.filter(models.Member.position > after)
+    stmt = stmt.order_by(models.Member.position).limit(limit)
+    return await session.execute(stmt)
+
+
+async def get_cell_owner(
+    path: str, session: AsyncSession
+):
+    """Получает id владельца ячейки и корень хранилища с её файлом по её пути"""
+    stmt = (
+        select(models.Storage.user_id, models.Cell.root)
+        .join(models.Cell, models.Cell.storage_id == models.Storage.id)
+        .where(models.Cell.path == path)
+        .limit(1)
+    )
+    row = (await session.execute(stmt)).one_or_none()
+    if row is None:
+        raise InstanceNotExists(f"Cell does not exists with path = {path}")
+    return row
+
+
+async def get_session_storage(
+    session_id: str, session: AsyncSession
+) -> models.Storage:
+    """Получает хранилище по сессии загрузки"""
+    try:
+        session_uuid = uuid.UUID(session_id)
+    except ValueError:
+        raise InstanceNotExists(f"UploadSession does not exists with session = {session_id}")
+    stmt = (
+        select(models.Storage)
+        .join(models.UploadSession, models.UploadSession.storage_id == models.Storage.id)
+        .where(models.UploadSession.session == session_uuid)
+    )
+    storage = await session.scalar(stmt)
+    if not storage:
+        raise InstanceNotExists(f"UploadSession does not exists with session = {session_id}")
+    return storage
+
+
+async def get_storage_addresses(
+    storage_id: int, session: AsyncSession
+) -> list[int]:
+    """Получает адреса уже загруженных ячеек хранилища"""
+    stmt = select(models.Cell.address).where(models.Cell.storage_id == storage_id)
+    return list(await session.scalars(stmt))
+
+
+async def cell_exists(
+    storage_id: int, address: int, session: AsyncSession
+) -> bool:
+    """Проверяет, сохранена ли ячейка хранилища с этим адресом"""
+    stmt = select(models.Cell.id).where(models.Cell.storage_id == storage_id, models.Cell.address == address)
+    return await session.scalar(stmt.limit(1)) is not None
+
+
+async def get_known_blobs(
+    paths: list[str], session: AsyncSession
+) -> list[str]:
+    """Получает дайджесты тех content-addressed блобов из списка путей,
+    на которые уже ссылается хотя бы одна ячейка"""
+    stmt = (
+        select(models.Cell.digest)
+        .where(models.Cell.path.in_(paths))
+        .distinct()
+    )
+    return list(await session.scalars(stmt))
+
+
+async def get_expired_sessions(
+    before: datetime, limit: int, session: AsyncSession
+):
+    """Получает сессии загрузки, созданные раньше before: (session, storage_id, user_id, completed).
+    Строки, заблокированные другим процессом, пропускаются"""
+    stmt = (
+        select(
+            models.UploadSession.session, models.UploadSession.storage_id,
+            models.Storage.user_id, models.Storage.completed,
+        )
+        .join(models.Storage, models.Storage.id == models.UploadSession.storage_id)
+        .where(models.UploadSession.created_at < before)
+        .limit(limit)
+        .with_for_update(of=models.UploadSession, skip_locked=True)
+    )
+    return (await session.execute(stmt)).all()
+
+
+async def get_orphan_storages(
+    before: datetime, after: int | None, limit: int, session: AsyncSession
+):
+    """Получает незавершённые хранилища без сессии загрузки, созданные раньше before,
+    (id, user_id) по возрастанию id, after - последний id предыдущей страницы.
+    Их уже никто не сможет догрузить"""
+    has_session = (
+        select(models.UploadSession.session).where(models.UploadSession.storage_id == models.Storage.id).exists()
+    )
+    stmt = select(models.Storage.id, models.Storage.user_id).where(
+        models.Storage.completed == false(), models.Storage.created_at < before, ~has_session
+    )
+    if after is not None:
+        stmt = stmt.where(models.Storage.id > after)
+    stmt = stmt.order_by(models.Storage.id).limit(limit)
+    return (await session.execute(stmt)).all()
+
+
+async def get_existing_storages(
+    storage_ids: list[int], session: AsyncSession
+) -> set[int]:
+    """Получает те id из списка, хранилища с которыми есть в БД"""
+    if not storage_ids:
+        return set()
+    stmt = select(models.Storage.id).where(models.Storage.id.in_(storage_ids))
+    return set(await session.scalars(stmt))
+
+
+async def add_uploaded_cells(
+    counts: dict[int, int], session: AsyncSession
+) -> None:
+    """Прибавляет к счётчикам хранилищ число закоммиченных ячеек,
+    хранилище становится завершённым, когда счётчик достигает size. Транзакция не фиксируется"""
+    # storages are updated in one order so concurrent batches don't deadlock
+    for storage_id, count in sorted(counts.items()):
+        uploaded = models.Storage.uploaded + count
+        await session.execute(
+            update(models.Storage)
+            .where(models.Storage.id == storage_id)
+            .values(uploaded=uploaded, completed=uploaded >= models.Storage.size)
+        )
+
+
+async def get_storage_blobs(
+    storage_ids: list[int], session: AsyncSession
+):
+    """Получает (path, root) content-addressed блобов, на которые ссылаются ячейки хранилищ"""
+    stmt = (
+        select(models.Cell.path, models.Cell.root)
+        .where(models.Cell.storage_id.in_(storage_ids), models.Cell.path.like("user_%/blobs/%"))
+        .distinct()
+    )
+    return (await session.execute(stmt)).all()
+
+
+async def lock_path(
+    path: str, session: AsyncSession
+) -> None:
+    """Блокирует путь файла до конца транзакции, чтобы проверка файла и запись ячейки
+    не пересекались с его удалением. Только для Postgres (advisory lock),
+    SQLite используется лишь для бенчмарков"""
+    if session.bind.dialect.name == "postgresql":
+        await session.execute(select(func.pg_advisory_xact_lock(func.hashtext(path))))
+
+
+async def get_referenced_paths(
+    paths: list[str], session: AsyncSession
+) -> set[str]:
+    """Получает те пути из списка, на которые ещё ссылается хотя бы одна ячейка"""
+    if not paths:
+        return set()
+    stmt = select(models.Cell.path).where(models.Cell.path.in_(paths)).distinct()
+    return set(await session.scalars(stmt))
+
+
+async def delete_upload_sessions(
+    session_ids: list, session: AsyncSession
+) -> None:
+    """Удаляет сессии загрузки. Транзакция не фиксируется"""
+    await session.execute(
+        sql_delete(models.UploadSession).where(models.UploadSession.session.in_(session_ids))
+    )
+
+
+async def delete_storages(
+    storage_ids: list[int], session: AsyncSession, user_id: int | None = None
+):
+    """Удаляет хранилища одним запросом, ячейки и сессии удаляются базой по ON DELETE CASCADE.
+    С user_id удаляются только хранилища этого пользователя. Возвращает (id, user_id) удалённых.
+    Транзакция не фиксируется"""
+    if not storage_ids:
+        return []
+    stmt = sql_delete(models.Storage).where(models.Storage.id.in_(storage_ids))
+    if user_id is not None:
+        stmt = stmt.where(models.Storage.user_id == user_id)
+    stmt = stmt.returning(models.Storage.id, models.Storage.user_id).execution_options(synchronize_session=False)
+    return (await session.execute(stmt)).all()
@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Any, Dict, List
 
 from sqlalchemy import (
@@ -7,54 +8,117 @@ from sqlalchemy import (
     UniqueConstraint,
     select,
     Integer,
-    Uuid
+    BigInteger,
+    Boolean,
+    DateTime,
+    Index,
+    Uuid,
+    false,
+    func,
 )
 from sqlalchemy.ext.associationproxy import AssociationProxy, association_proxy
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .database import Base
+from ..settings import CELL_SIZE
 
+# storage layouts: a file per cell or one preallocated data file with cells at fixed offsets
+LAYOUT_CELLS = "cells"
+LAYOUT_PACKED = "packed"
+# cells of a compressed storage are compressed by the client and stored as is
+CODEC_NONE = "none"
 
 
 class Cell(AsyncAttrs, Base):
     __tablename__ = "cells"
+    # path is not unique: content-addressed cells with the same digest share one blob,
+    # the number of Cell rows with the blob path is the reference count of the blob.
+    # storage_id goes first so the unique index also serves cell pages of a storage ordered by address
     __table_args__ = UniqueConstraint(
-        "address", "storage_id"
-    ), UniqueConstraint("path")
+        "storage_id", "address"
+    ),
     id: Mapped[int] = mapped_column(primary_key=True)
-    path: Mapped[str] = mapped_column(String())
+    path: Mapped[str] = mapped_column(String(), index=True)
     address: Mapped[int] = mapped_column(Integer(), default=0)
+    # sha256 of the cell content
+    digest: Mapped[str | None] = mapped_column(String(64), index=True, nullable=True)
+    # only for packed storages: position of the cell in the storage data file
+    offset: Mapped[int | None] = mapped_column(BigInteger(), nullable=True)
+    length: Mapped[int | None] = mapped_column(Integer(), nullable=True)
+    # number of the storage root with the file
+    root: Mapped[int] = mapped_column(Integer(), default=0, server_default="0")
     storage_id: Mapped["int"] = mapped_column(
         ForeignKey("storage.id", onupdate="CASCADE", ondelete="CASCADE")
     )
-    storage: Mapped["Storage"] = relationship(lazy="joined", back_populates="cells")
+    storage: Mapped["Storage"] = relationship(lazy="raise", back_populates="cells")
 
 
 class Storage(AsyncAttrs, Base):
     __tablename__ = "storage"
+    # keyset pagination of the user storage list walks this index,
+    # the sweeper walks the incomplete storages by the second one
+    __table_args__ = (
+        Index("ix_storage_user_id_id", "user_id", "id"),
+        Index("ix_storage_completed_id", "completed", "id"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String())
     size: Mapped[int] = mapped_column(Integer())
+    layout: Mapped[str] = mapped_column(String(), default=LAYOUT_CELLS, server_default=LAYOUT_CELLS)
+    codec: Mapped[str] = mapped_column(String(), default=CODEC_NONE, server_default=CODEC_NONE)
+    # every cell but the last one is exactly cell_size bytes (before compression)
+    cell_size: Mapped[int] = mapped_column(Integer(), default=CELL_SIZE, server_default=str(CELL_SIZE))
+    # only for packed storages: storage root of the data file
+    root: Mapped[int] = mapped_column(Integer(), default=0, server_default="0")
+    # the content is a directory: its files are laid one after another and indexed by Member rows
+    archive: Mapped[bool] = mapped_column(Boolean(), default=False, server_default=false())
+    # number of committed cells, the storage is completed when its last cell is committed
+    uploaded: Mapped[int] = mapped_column(Integer(), default=0, server_default="0")
+    completed: Mapped[bool] = mapped_column(Boolean(), default=False, server_default=false())
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     user_id: Mapped["int"] = mapped_column(
         ForeignKey("users.id", onupdate="CASCADE", ondelete="CASCADE")
     )
-    user: Mapped["User"] = relationship(lazy="joined", back_populates="storage_list")
-    cells: Mapped[List["Cell"]] = relationship(lazy="joined", back_populates="storage")
+    user: Mapped["User"] = relationship(lazy="raise", back_populates="storage_list")
+    cells: Mapped[List["Cell"]] = relationship(lazy="raise", back_populates="storage", passive_deletes=True)
+    members: Mapped[List["Member"]] = relationship(lazy="raise", back_populates="storage", passive_deletes=True)
+
+
+class Member(AsyncAttrs, Base):
+    __tablename__ = "members"
+    # position is the number of the file in the archive, the client may resend a page of the index
+    # and the unique index also serves member pages of a storage ordered by position
+    __table_args__ = UniqueConstraint(
+        "storage_id", "position"
+    ),
+    id: Mapped[int] = mapped_column(primary_key=True)
+    position: Mapped[int] = mapped_column(Integer())
+    # relative posix path of the file inside the archive
+    name: Mapped[str] = mapped_column(String())
+    # bytes of the file in the storage content, cells are cut from it regardless of the file borders
+    offset: Mapped[int] = mapped_column(BigInteger())
+    length: Mapped[int] = mapped_column(BigInteger())
+    storage_id: Mapped["int"] = mapped_column(
+        ForeignKey("storage.id", onupdate="CASCADE", ondelete="CASCADE")
+    )
+    storage: Mapped["Storage"] = relationship(lazy="raise", back_populates="members")
 
 
 class User(AsyncAttrs, Base):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str]
-    api_key: Mapped[str]
-    storage_list: Mapped[List["Storage"]] = relationship(lazy="joined", back_populates="user")
+    api_key: Mapped[str] = mapped_column(String(), unique=True, index=True)
+    storage_list: Mapped[List["Storage"]] = relationship(lazy="raise", back_populates="user", passive_deletes=True)
 
 
 class UploadSession(AsyncAttrs, Base):
     __tablename__ = "uploadsessions"
     session: Mapped[str] = mapped_column(Uuid(), primary_key=True)
     storage_id: Mapped[int] = mapped_column(
-        ForeignKey("storage.id", onupdate="CASCADE", ondelete="CASCADE")
+        ForeignKey("storage.id", onupdate="CASCADE", ondelete="CASCADE"), index=True
     )
-    storage: Mapped["Storage"] = relationship("Storage", lazy="joined")
\ No newline at end of file
+    # sessions older than UPLOAD_SESSION_TTL are removed by the sweeper
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+    storage: Mapped["Storage"] = relationship("Storage", lazy="raise")
\ No newline at end of file
@@ -0,0 +1,86 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple
+
+from ..settings import AUTH_CACHE_SIZE, AUTH_CACHE_TTL, UPLOAD_SESSION_CACHE_SIZE, UPLOAD_SESSION_CACHE_TTL
+
+
+class UserIdentity(NamedTuple):
+    """Lightweight authenticated user, enough for access checks"""
+    id: int
+    name: str
+
+
+class UploadStorage(NamedTuple):
+    """Storage of an upload session, enough to validate and place cells without a query"""
+    id: int
+    user_id: int
+    name: str
+    size: int
+    layout: str
+    cell_size: int
+    codec: str
+    root: int
+    archive: bool
+
+
+class TTLCache:
+    """Bounded LRU map, entries expire after ttl seconds"""
+
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < self._clock():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (self._clock() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Any], bool]) -> None:
+        for key, (_, value) in list(self._data.items()):
+            if predicate(value):
+                del self._data[key]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class AuthCache(TTLCache):
+    """api-key -> UserIdentity. Only found users are cached, so a registered key works at once.
+    The API never changes or deletes users: a user changed in the database by other means
+    stays cached for up to ttl seconds unless invalidate_user is called"""
+
+    def invalidate_user(self, user_id: int) -> None:
+        self.invalidate_where(lambda identity: identity.id == user_id)
+
+
+class UploadSessionCache(TTLCache):
+    """upload session -> UploadStorage. Sessions and storages are deleted by bulk statements,
+    their callers invalidate the entries"""
+
+    def invalidate_storage(self, storage_id: int) -> None:
+        self.invalidate_where(lambda storage: storage.id == storage_id)
+
+
+auth_cache = AuthCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+upload_session_cache = UploadSessionCache(UPLOAD_SESSION_CACHE_SIZE, UPLOAD_SESSION_CACHE_TTL)
+
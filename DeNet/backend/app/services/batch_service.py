@@ -0,0 +1,134 @@
+"""Group commit of Cell rows: rows of concurrent uploads are inserted by one multi-row INSERT and one commit,
+the counters of uploaded cells of their storages are updated in the same transaction"""
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import NamedTuple
+
+from ..db import db_utils
+from ..db.models import Cell
+from ..settings import CELL_BATCH_ROWS, CELL_BATCH_DELAY
+from .metrics_service import observe_cell_batch
+
+
+class PendingCell(NamedTuple):
+    values: dict
+    future: asyncio.Future
+
+
+class CellBatcher:
+    """Collects Cell rows and commits them in batches of max_rows rows,
+    a batch is not kept open longer than max_delay seconds after its first row"""
+
+    def __init__(self, max_rows: int, max_delay: float):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._pending: list[PendingCell] = []
+        self._session_maker = None
+        self._task = None
+        self._stopping = False
+
+    def start(self, session_maker) -> None:
+        self._session_maker = session_maker
+        self._stopping = False
+        self._has_rows = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Commits the rows already added and stops"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._has_rows.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+    async def add(self, **values) -> int:
+        """Queues the Cell row and returns its id once the batch with it is committed.
+        InstanceAlreadyExists if the cell with this address is already in the storage"""
+        if self._task is None or self._stopping:
+            raise RuntimeError("Cell batcher is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(PendingCell(values, future))
+        self._has_rows.set()
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+        return await future
+
+    async def _run(self) -> None:
+        while self._pending or not self._stopping:
+            await self._has_rows.wait()
+            if len(self._pending) < self.max_rows and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._pending[:self.max_rows]
+            del self._pending[:self.max_rows]
+            if not self._pending and not self._stopping:
+                self._has_rows.clear()
+            if len(self._pending) < self.max_rows and not self._stopping:
+                self._full.clear()
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: list[PendingCell]) -> None:
+        start = time.perf_counter()
+        # the same cell sent twice in one batch: only the first one may be inserted
+        unique, duplicates = {}, []
+        for cell in batch:
+            key = (cell.values["storage_id"], cell.values["address"])
+            if key in unique:
+                duplicates.append(cell)
+            else:
+                unique[key] = cell
+        try:
+            async with self._session_maker() as session:
+                inserted = await db_utils.insert_many(
+                    Cell, session, [cell.values for cell in unique.values()], "storage_id", "address"
+                )
+                await db_utils.add_uploaded_cells(Counter(storage_id for storage_id, _ in inserted), session)
+                await session.commit()
+        except Exception:
+            # one bad row (e.g. its storage was deleted) must not fail the others
+            logging.exception("Cell batch failed, inserting its rows one by one")
+            for cell in unique.values():
+                await self._insert_one(cell)
+        else:
+            for key, cell in unique.items():
+                self._resolve(cell, inserted.get(key))
+        for cell in duplicates:
+            self._resolve(cell, None)
+        observe_cell_batch(len(batch), time.perf_counter() - start)
+
+    async def _insert_one(self, cell: PendingCell) -> None:
+        try:
+            async with self._session_maker() as session:
+                pk = await db_utils.insert_or_fail(Cell, session, **cell.values)
+                await db_utils.add_uploaded_cells({cell.values["storage_id"]: 1}, session)
+                await session.commit()
+        except db_utils.InstanceAlreadyExists:
+            self._resolve(cell, None)
+        except Exception as err:
+            self._resolve(cell, None, err)
+        else:
+            self._resolve(cell, pk)
+
+    @staticmethod
+    def _resolve(cell: PendingCell, pk: int | None, error: Exception | None = None) -> None:
+        if cell.future.done():
+            return
+        if error is not None:
+            cell.future.set_exception(error)
+        elif pk is None:
+            cell.future.set_exception(db_utils.InstanceAlreadyExists(
+                f"Cell {cell.values['address']} of storage {cell.values['storage_id']} already exists"
+            ))
+        else:
+            cell.future.set_result(pk)
+
+
+cell_batcher = CellBatcher(CELL_BATCH_ROWS, CELL_BATCH_DELAY)
@@ -0,0 +1,162 @@
+"""Blocking disk I/O of cell writes and the durability policy of acknowledged cells"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from ..settings import DISK_IO_WORKERS, DURABILITY, DURABILITY_GROUP_DELAY
+from .metrics_service import observe_disk_write, observe_sync_group
+
+# data is left to the page cache, a cell may be lost on power failure after it is acknowledged
+DURABILITY_NONE = "none"
+# every written file is synced before its cell is acknowledged
+DURABILITY_FDATASYNC = "fdatasync"
+# files written within group_delay seconds are synced by one job before their cells are acknowledged
+DURABILITY_GROUP = "group"
+
+
+class PendingSync(NamedTuple):
+    # a file descriptor to sync and close or a directory to sync
+    fd: int | None
+    directory: str | None
+    future: asyncio.Future
+
+
+def _sync_file(fd: int) -> None:
+    start = time.perf_counter()
+    os.fdatasync(fd)
+    observe_disk_write("fdatasync", 0, time.perf_counter() - start)
+
+
+def _sync_directory(directory: str) -> None:
+    """Makes the names created or renamed in the directory durable"""
+    start = time.perf_counter()
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    observe_disk_write("fsync_dir", 0, time.perf_counter() - start)
+
+
+def _sync_and_close(fd: int) -> None:
+    try:
+        _sync_file(fd)
+    finally:
+        os.close(fd)
+
+
+def _sync_group(group: list[PendingSync]) -> list[Exception | None]:
+    """Syncs the files and then the directories of the group, every directory once.
+    Returns the error of every item"""
+    errors = []
+    for item in group:
+        if item.fd is None:
+            errors.append(None)
+            continue
+        try:
+            _sync_and_close(item.fd)
+            errors.append(None)
+        except OSError as err:
+            errors.append(err)
+    directories = {}
+    for item in group:
+        if item.directory is not None and item.directory not in directories:
+            try:
+                _sync_directory(item.directory)
+                directories[item.directory] = None
+            except OSError as err:
+                directories[item.directory] = err
+    return [
+        directories[item.directory] if item.directory is not None else error
+        for item, error in zip(group, errors)
+    ]
+
+
+class DiskIO:
+    """Runs blocking file operations in its own pool of workers threads, not in the default
+    executor shared with aiofiles, and syncs written files according to durability.
+    In the group mode syncs requested within group_delay seconds are done by one job,
+    so concurrent uploads share the wait for the disk"""
+
+    def __init__(self, workers: int = DISK_IO_WORKERS, durability: str = DURABILITY,
+                 group_delay: float = DURABILITY_GROUP_DELAY):
+        if durability not in (DURABILITY_NONE, DURABILITY_FDATASYNC, DURABILITY_GROUP):
+            raise ValueError(f"Unknown durability {durability}")
+        self.workers = workers
+        self.durability = durability
+        self.group_delay = group_delay
+        self._executor = None
+        self._group: list[PendingSync] = []
+        # the flush collecting the current group, the previous ones may still be syncing
+        self._flush_task = None
+        self._flushes = set()
+
+    def start(self) -> None:
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="disk-io")
+
+    async def stop(self) -> None:
+        """Syncs the pending group and waits for the operations already started"""
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def run(self, func, *args):
+        if self._executor is None:
+            raise RuntimeError("Disk I/O is not running")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def close(self, fd: int, sync: bool = True) -> None:
+        """Closes the written file, with sync it is durable once this returns.
+        The descriptor is closed even if the caller is cancelled meanwhile"""
+        if not sync or self.durability == DURABILITY_NONE:
+            await asyncio.shield(self.run(os.close, fd))
+        elif self.durability == DURABILITY_FDATASYNC:
+            await asyncio.shield(self.run(_sync_and_close, fd))
+        else:
+            await asyncio.shield(self._add_to_group(fd, None))
+
+    async def sync_directory(self, directory) -> None:
+        """Makes a file created or renamed in the directory durable"""
+        if self.durability == DURABILITY_NONE:
+            return
+        if self.durability == DURABILITY_FDATASYNC:
+            await asyncio.shield(self.run(_sync_directory, str(directory)))
+        else:
+            await asyncio.shield(self._add_to_group(None, str(directory)))
+
+    def _add_to_group(self, fd: int | None, directory: str | None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._group.append(PendingSync(fd, directory, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_group())
+            self._flushes.add(self._flush_task)
+            self._flush_task.add_done_callback(self._flushes.discard)
+        return future
+
+    async def _flush_group(self) -> None:
+        await asyncio.sleep(self.group_delay)
+        # syncs requested from now on go to the next group
+        group, self._group = self._group, []
+        self._flush_task = None
+        start = time.perf_counter()
+        try:
+            errors = await self.run(_sync_group, group)
+        except Exception as err:
+            logging.exception("Group sync failed")
+            errors = [err] * len(group)
+        observe_sync_group(len(group), time.perf_counter() - start)
+        for item, error in zip(group, errors):
+            if item.future.done():
+                continue
+            if error is not None:
+                item.future.set_exception(error)
+            else:
+                item.future.set_result(None)
+
+
+disk_io = DiskIO()
@@ -1,22 +1,234 @@
+import hashlib
+import os
+import time
+import uuid
 from pathlib import Path
+from typing import AsyncIterator
 
 import aiofiles
 from fastapi import UploadFile
 
-from ..db.models import User, Storage
-
-
-async def write_to_storage(user: User, file: UploadFile, storage_path:str, storage: Storage, address: int) -> str:
-    # with open(f'{MEDIA_PATH}/user_{user.id}/storage_{storage.id}', "rb") as file:
-    #     file.write(data)
-    path = Path(f"user_{user.id}/storage_{storage.id}")
-    absolute_path = Path(storage_path).absolute() / path
-    absolute_path.mkdir(exist_ok=True, parents=True)
-    if file.filename:
-        file_path = path / f'{address}_{file.filename}'
-    else:
-        file_path = path / f'{address}_UPLOAD'
-    content = await file.read()
-    async with aiofiles.open(storage_path / file_path, mode="wb") as f:
-        await f.write(content)
-    return str(file_path)
+from ..db.db_utils import CRUDException, CellTooLarge
+from ..db.models import User, Storage, CODEC_NONE
+from .disk_service import disk_io
+from .metrics_service import observe_disk_write
+
+CHUNK_SIZE = 64 * 1024
+# incompressible content grows a little when compressed, zlib and zstd stay within this bound
+CODEC_OVERHEAD = 1024
+
+
+def get_cell_limit(cell_size: int, codec: str) -> int:
+    """Biggest body of a cell of the storage"""
+    if codec == CODEC_NONE:
+        return cell_size
+    return cell_size + cell_size // 128 + CODEC_OVERHEAD
+
+
+def get_storage_dir(user_id: int, storage_id: int) -> Path:
+    """Relative directory with the cell files and the data file of the storage"""
+    return Path(f"user_{user_id}/storage_{storage_id}")
+
+
+def get_cell_path(user: User, storage: Storage, address: int) -> Path:
+    """Relative path of the cell file in the media storage. The name never comes from the client"""
+    return get_storage_dir(user.id, storage.id) / str(address)
+
+
+def get_blob_path(user: User, digest: str) -> Path:
+    """Relative path of the content-addressed blob, shared by all user cells with this digest"""
+    return Path(f"user_{user.id}/blobs/{digest[:2]}/{digest}")
+
+
+def get_data_path(user: User, storage_id: int) -> Path:
+    """Relative path of the data file of a packed storage"""
+    return get_storage_dir(user.id, storage_id) / "data"
+
+
+ADDRESS_PLACEHOLDER = "{address}"
+
+
+def get_path_template(addresses: list[int], paths: list[str]) -> str | None:
+    """Common template of the cell paths with ADDRESS_PLACEHOLDER in place of the cell address.
+    None if the paths don't follow one template (e.g. content-addressed blobs)"""
+    if not paths or ADDRESS_PLACEHOLDER in paths[0]:
+        return None
+    directory, _, name = paths[0].rpartition("/")
+    prefix = f"{addresses[0]}_"
+    template = paths[0]
+    if name == str(addresses[0]):
+        template = f"{directory}/{ADDRESS_PLACEHOLDER}"
+    elif name.startswith(prefix):
+        # cells stored before the names were fixed are "{address}_{file name}"
+        template = f"{directory}/{ADDRESS_PLACEHOLDER}_{name[len(prefix):]}"
+    for address, path in zip(addresses, paths):
+        if template.replace(ADDRESS_PLACEHOLDER, str(address)) != path:
+            return None
+    return template
+
+
+async def iter_upload_file(file: UploadFile) -> AsyncIterator[bytes]:
+    while chunk := await file.read(CHUNK_SIZE):
+        yield chunk
+
+
+def _write_at(fd: int, data, offset: int) -> None:
+    """Blocking write of all data at offset"""
+    start = time.perf_counter()
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+    observe_disk_write("write", len(data), time.perf_counter() - start)
+
+
+async def _copy_stream(stream: AsyncIterator[bytes], fd: int, limit: int | None = None,
+                       offset: int = 0) -> tuple[int, str]:
+    """Writes the stream to the open file from offset by CHUNK_SIZE pieces without buffering the whole cell,
+    returns written length and sha256 of the content"""
+    hasher = hashlib.sha256()
+    written = 0
+    buffer = bytearray()
+    async for chunk in stream:
+        hasher.update(chunk)
+        buffer += chunk
+        if limit is not None and written + len(buffer) > limit:
+            raise CellTooLarge(f"Cell is bigger than {limit} bytes")
+        if len(buffer) >= CHUNK_SIZE:
+            await disk_io.run(_write_at, fd, buffer, offset + written)
+            written += len(buffer)
+            buffer.clear()
+    if buffer:
+        await disk_io.run(_write_at, fd, buffer, offset + written)
+        written += len(buffer)
+    return written, hasher.hexdigest()
+
+
+async def _write_file(stream: AsyncIterator[bytes], fd: int, limit: int | None = None,
+                      offset: int = 0) -> tuple[int, str]:
+    """Copies the stream to the file and closes it, the file is synced by the durability policy
+    unless the copy failed"""
+    try:
+        result = await _copy_stream(stream, fd, limit, offset)
+    except BaseException:
+        await disk_io.close(fd, sync=False)
+        raise
+    await disk_io.close(fd)
+    return result
+
+
+async def write_to_temp(stream: AsyncIterator[bytes], storage_path: str, file_path: Path,
+                        limit: int | None = None) -> tuple[Path, str]:
+    """Writes the body of at most limit bytes to a unique temporary file next to file_path,
+    returns its absolute path and sha256 of the content. The content is durable
+    by the durability policy, the name is made durable after the file is placed"""
+    absolute_path = Path(storage_path).absolute() / file_path
+    absolute_path.parent.mkdir(exist_ok=True, parents=True)
+    temp_path = absolute_path.with_name(f"{absolute_path.name}.{uuid.uuid4().hex}.tmp")
+    fd = await disk_io.run(os.open, temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        _, digest = await _write_file(stream, fd, limit)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return temp_path, digest
+
+
+def place_temp_file(temp_path: Path, storage_path: str, file_path: Path) -> None:
+    """Moves the temporary file to file_path, the temporary file is removed if it can't be moved.
+    Cell files are placed before their row is committed, so a committed cell always has its file"""
+    try:
+        os.replace(temp_path, Path(storage_path).absolute() / file_path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+async def write_blob_to_temp(stream: AsyncIterator[bytes], storage_path: str, file_path: Path,
+                             digest: str, limit: int | None = None) -> Path:
+    """Streams the body to a temporary file next to the blob path while hashing it,
+    returns the temporary path only if the sha256 of the content matches the digest.
+    The caller places it with place_temp_file, replace is atomic for identical concurrent blobs"""
+    temp_path, written_digest = await write_to_temp(stream, storage_path, file_path, limit)
+    if written_digest != digest:
+        temp_path.unlink(missing_ok=True)
+        raise CRUDException("Cell content does not match its digest")
+    return temp_path
+
+
+def get_cells_length(last_path: Path | None, count: int, cell_size: int) -> int:
+    """Total length of the file composed of count cells.
+    All cells but the last one are cell_size bytes"""
+    if not count:
+        return 0
+    return cell_size * (count - 1) + last_path.stat().st_size
+
+
+def parse_range(header: str | None, total: int) -> tuple[int, int] | None:
+    """Parses single "bytes=start-end" range, returns inclusive (start, end).
+    None means the whole file, ValueError means unsatisfiable range"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if not start:
+            suffix = int(end)
+            if suffix <= 0:
+                raise ValueError("Empty suffix range")
+            return max(total - suffix, 0), total - 1
+        start = int(start)
+        end = min(int(end), total - 1) if end else total - 1
+    except ValueError:
+        raise ValueError(f"Wrong range {header}")
+    if start > end or start >= total:
+        raise ValueError(f"Range {header} is not satisfiable")
+    return start, end
+
+
+async def read_cells(cells: list[tuple[Path, int]], cell_size: int, start: int, end: int) -> AsyncIterator[bytes]:
+    """Yields bytes start..end (inclusive) of the file composed of cells in address order.
+    Every cell is a (absolute path, offset of the cell in that file) pair"""
+    position = start
+    while position <= end:
+        index, offset = divmod(position, cell_size)
+        remaining = min(cell_size - offset, end - position + 1)
+        path, base = cells[index]
+        async with aiofiles.open(path, mode="rb") as f:
+            await f.seek(base + offset)
+            while remaining:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise OSError(f"Cell {path} is truncated")
+                remaining -= len(chunk)
+                position += len(chunk)
+                yield chunk
+
+
+async def allocate_data_file(storage_path: str, file_path: Path, length: int) -> None:
+    """Creates the data file of a packed storage and reserves length bytes for it"""
+    absolute_path = Path(storage_path).absolute() / file_path
+    absolute_path.parent.mkdir(exist_ok=True, parents=True)
+
+    def allocate(fd):
+        if length and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, length)
+        else:
+            os.ftruncate(fd, length)
+
+    fd = await disk_io.run(os.open, absolute_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        await disk_io.run(allocate, fd)
+    except BaseException:
+        await disk_io.close(fd, sync=False)
+        raise
+    await disk_io.close(fd)
+    await disk_io.sync_directory(absolute_path.parent)
+
+
+async def write_stream_at(stream: AsyncIterator[bytes], storage_path: str, file_path: Path, offset: int,
+                          limit: int) -> tuple[int, str]:
+    """Writes the body into the data file at offset, returns written length and sha256.
+    The body must not be longer than limit so it can't overlap the next cell"""
+    fd = await disk_io.run(os.open, Path(storage_path) / file_path, os.O_WRONLY)
+    return await _write_file(stream, fd, limit, offset)
@@ -0,0 +1,151 @@
+"""Prometheus metrics: request latency per route, SQL and commit timings, connection pool, disk writes"""
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DISK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+REQUEST_LATENCY = Histogram(
+    "denet_request_seconds", "Request latency until the response body is sent",
+    ("method", "route", "status"), buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge("denet_requests_in_progress", "Requests being processed")
+SQL_LATENCY = Histogram(
+    "denet_sql_seconds", "SQL statement execution time", ("operation",), buckets=LATENCY_BUCKETS,
+)
+SQL_ERRORS = Counter("denet_sql_errors_total", "Failed SQL statements", ("operation",))
+COMMIT_LATENCY = Histogram("denet_sql_commit_seconds", "Session commit time", buckets=LATENCY_BUCKETS)
+POOL_SIZE = Gauge("denet_db_pool_size", "Connections kept in the pool")
+POOL_CAPACITY = Gauge("denet_db_pool_capacity", "Pool size plus allowed overflow")
+POOL_CHECKED_OUT = Gauge("denet_db_pool_checked_out", "Connections in use")
+POOL_CHECKOUTS = Counter("denet_db_pool_checkouts_total", "Connections taken from the pool")
+DISK_WRITE_LATENCY = Histogram(
+    "denet_disk_write_seconds", "Latency of a single disk operation", ("operation",), buckets=DISK_BUCKETS,
+)
+CELL_BATCH_ROWS = Histogram(
+    "denet_cell_batch_rows", "Cell rows per group commit", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+CELL_BATCH_LATENCY = Histogram("denet_cell_batch_seconds", "Group commit time", buckets=LATENCY_BUCKETS)
+SWEPT_SESSIONS = Counter(
+    "denet_sweeper_sessions_total", "Expired upload sessions by the state of their storage", ("storage",),
+)
+SWEPT_ORPHANS = Counter(
+    "denet_sweeper_orphans_total", "Leftovers found by the sweeper", ("kind",),
+)
+SWEEP_ERRORS = Counter("denet_sweeper_errors_total", "Failed sweeps")
+SWEEP_BATCH_LATENCY = Histogram("denet_sweeper_batch_seconds", "Sweeper batch time", buckets=LATENCY_BUCKETS)
+REMOVED_FILES = Counter("denet_removed_files_total", "Files of deleted storages removed from the disks")
+REMOVAL_ERRORS = Counter("denet_removal_errors_total", "Failed file removals")
+REMOVAL_QUEUE = Gauge("denet_removal_queue", "Directories and blobs waiting for removal")
+DISK_WRITE_BYTES = Counter("denet_disk_write_bytes_total", "Bytes written to the media storage")
+DISK_SYNC_GROUP = Histogram(
+    "denet_disk_sync_group_files", "Files and directories synced by one group fsync",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware observing request latency labeled by the route template, not the raw path"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_PROGRESS.dec()
+            # the router puts the matched route into the scope
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(
+                scope["method"], getattr(route, "path", "unmatched"), status_code
+            ).observe(time.perf_counter() - start)
+
+
+class MeteredSession(AsyncSession):
+    """AsyncSession observing commit time"""
+
+    async def commit(self) -> None:
+        start = time.perf_counter()
+        try:
+            await super().commit()
+        finally:
+            COMMIT_LATENCY.observe(time.perf_counter() - start)
+
+
+def _get_operation(statement: str) -> str:
+    return statement.lstrip().split(None, 1)[0].upper() if statement else "UNKNOWN"
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Adds statement timing and pool listeners to the sync engine behind the async one"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start"].pop()
+        SQL_LATENCY.labels(_get_operation(statement)).observe(time.perf_counter() - start)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start"):
+            conn.info["query_start"].pop()
+        SQL_ERRORS.labels(_get_operation(exception_context.statement)).inc()
+
+    pool = engine.pool
+
+    @event.listens_for(pool, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_CHECKOUTS.inc()
+
+    # NullPool and StaticPool have no size accounting
+    if hasattr(pool, "checkedout"):
+        POOL_SIZE.set_function(pool.size)
+        POOL_CAPACITY.set_function(lambda: pool.size() + max(pool._max_overflow, 0))
+        POOL_CHECKED_OUT.set_function(pool.checkedout)
+
+
+def observe_disk_write(operation: str, length: int, seconds: float) -> None:
+    DISK_WRITE_LATENCY.labels(operation).observe(seconds)
+    DISK_WRITE_BYTES.inc(length)
+
+
+def observe_sync_group(items: int, seconds: float) -> None:
+    DISK_SYNC_GROUP.observe(items)
+    DISK_WRITE_LATENCY.labels("group_sync").observe(seconds)
+
+
+def observe_cell_batch(rows: int, seconds: float) -> None:
+    CELL_BATCH_ROWS.observe(rows)
+    CELL_BATCH_LATENCY.observe(seconds)
+
+
+def observe_sweep_batch(completed: int, abandoned: int, seconds: float) -> None:
+    SWEPT_SESSIONS.labels("completed").inc(completed)
+    SWEPT_SESSIONS.labels("abandoned").inc(abandoned)
+    SWEEP_BATCH_LATENCY.observe(seconds)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Metrics in the Prometheus text format and their content type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
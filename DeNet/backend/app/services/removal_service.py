@@ -0,0 +1,142 @@
+"""Deletion of storages: rows go in one statement, files are removed later in the background"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from ..db import db_utils
+from ..settings import REMOVAL_WORKERS, REMOVAL_RATE
+from .file_service import get_storage_dir
+from .metrics_service import REMOVED_FILES, REMOVAL_ERRORS, REMOVAL_QUEUE
+from .root_service import StorageRoots, storage_roots
+
+
+class StorageRemoval(NamedTuple):
+    """What is left on the disks after the storages are deleted from the database"""
+    # (id, user_id) of the deleted storages
+    storages: list[tuple[int, int]]
+    # (root, path) of the blobs no cell refers to anymore
+    blobs: list[tuple[int, str]]
+    # (root, path) of other files nothing refers to, e.g. stale temporary files
+    files: list[tuple[int, str]] = []
+
+
+async def delete_storages(storage_ids: list[int], orm_session, user_id: int | None = None) -> StorageRemoval:
+    """Deletes the storages with one statement, cells and sessions go by ON DELETE CASCADE.
+    The transaction is not committed, the files are scheduled for removal after the commit"""
+    blobs = await db_utils.get_storage_blobs(storage_ids, orm_session)
+    deleted = await db_utils.delete_storages(storage_ids, orm_session, user_id)
+    referenced = await db_utils.get_referenced_paths([blob.path for blob in blobs], orm_session)
+    return StorageRemoval(
+        [(row.id, row.user_id) for row in deleted],
+        [(blob.root, blob.path) for blob in blobs if blob.path not in referenced],
+    )
+
+
+class FileRemover:
+    """Removes files in its own pool of workers threads, not in the default executor used by aiofiles.
+    All workers together unlink at most rate files per second, so mass deletion leaves the disks to uploads.
+    A blob is unlinked only if no cell refers to it right before, under the lock of its path"""
+
+    def __init__(self, roots: StorageRoots, workers: int = REMOVAL_WORKERS, rate: float = REMOVAL_RATE):
+        self.roots = roots
+        self.workers = workers
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._executor = None
+        self._queue = None
+        self._tasks = []
+        self._session_maker = None
+
+    def start(self, session_maker) -> None:
+        self._session_maker = session_maker
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="file-remover")
+        self._queue = asyncio.Queue()
+        REMOVAL_QUEUE.set_function(self._queue.qsize)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Stops at once, files still in the queue stay on the disks"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def join(self) -> None:
+        """Waits until everything scheduled is removed"""
+        await self._queue.join()
+
+    def schedule(self, removal: StorageRemoval) -> None:
+        for storage_id, user_id in removal.storages:
+            # cells of one storage are spread over all roots
+            for root in range(len(self.roots.paths)):
+                self._queue.put_nowait((root, get_storage_dir(user_id, storage_id), "tree"))
+        for root, path in removal.blobs:
+            self._queue.put_nowait((root, path, "blob"))
+        for root, path in removal.files:
+            self._queue.put_nowait((root, path, "file"))
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            root, path, kind = await self._queue.get()
+            try:
+                if kind == "tree":
+                    removed = await loop.run_in_executor(self._executor, self._remove_tree, root, path)
+                elif kind == "blob":
+                    removed = await self._remove_blob(root, path)
+                else:
+                    removed = await loop.run_in_executor(self._executor, self._remove_file, root, path)
+                REMOVED_FILES.inc(removed)
+            except Exception:
+                REMOVAL_ERRORS.inc()
+                logging.exception("Couldn't remove %s on root %s", path, root)
+            finally:
+                self._queue.task_done()
+
+    async def _remove_blob(self, root: int, path: str) -> int:
+        """A cell may have been committed for the blob since its storage was deleted"""
+        async with self._session_maker() as orm_session:
+            await db_utils.lock_path(path, orm_session)
+            if await db_utils.get_referenced_paths([path], orm_session):
+                return 0
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._remove_file, root, path)
+
+    def _throttle(self) -> None:
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def _remove_tree(self, root: int, path) -> int:
+        removed = 0
+        for directory, _, files in os.walk(self.roots.get_file_path(root, path), topdown=False):
+            for name in files:
+                self._throttle()
+                try:
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+        return removed
+
+    def _remove_file(self, root: int, path: str) -> int:
+        self._throttle()
+        return int(self.roots.remove(root, path))
+
+
+file_remover = FileRemover(storage_roots)
@@ -0,0 +1,93 @@
+"""Local storage roots: on which root a cell file is placed and how nginx serves it.
+This is a root selector, not a pluggable storage backend: file_service reads and writes
+the files directly under the local directory of a root"""
+import hashlib
+import math
+import os
+import shutil
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from ..settings import STORAGE_ROOTS, STORAGE_SPACE_TTL
+
+
+class StorageRoots(ABC):
+    """Cell files live under numbered local directories, the roots.
+    Cell.path is relative to its root, Cell.root is the number. Roots are never renumbered, new ones are appended"""
+
+    paths: list[str]
+
+    @abstractmethod
+    def choose_root(self, key: str) -> int:
+        """Root for a new file. While the roots don't change the same key mostly gets the same root"""
+
+    @abstractmethod
+    def get_accel_path(self, root: int, path: str) -> str:
+        """Internal nginx location of the file for X-Accel-Redirect"""
+
+    def get_root_path(self, root: int) -> str:
+        """Local directory of the root, file_service functions write relative to it"""
+        return self.paths[root]
+
+    def get_file_path(self, root: int, path: str | Path) -> Path:
+        return Path(self.paths[root]).absolute() / path
+
+    def remove(self, root: int, path: str | Path) -> bool:
+        """Removes the file, False if there was nothing to remove"""
+        try:
+            os.remove(self.get_file_path(root, path))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def find_root(self, path: str | Path) -> int | None:
+        """Root which already has the file, e.g. a content-addressed blob"""
+        for root in range(len(self.paths)):
+            if self.get_file_path(root, path).is_file():
+                return root
+        return None
+
+
+class ShardedRoots(StorageRoots):
+    """Local directories, usually one per disk. A file goes to the root chosen by weighted
+    rendezvous hashing of its key: every root gets keys in proportion to its free space,
+    adding a root moves to it only the keys it wins"""
+
+    def __init__(self, paths: list[str], space_ttl: float = STORAGE_SPACE_TTL, clock=time.monotonic):
+        self.paths = paths
+        self.space_ttl = space_ttl
+        self._clock = clock
+        self._weights: list[int] | None = None
+        self._weights_time = 0.0
+
+    def choose_root(self, key: str) -> int:
+        if len(self.paths) == 1:
+            return 0
+        weights = self._get_weights()
+        return max(range(len(self.paths)), key=lambda root: self._get_score(key, root, weights[root]))
+
+    def get_accel_path(self, root: int, path: str) -> str:
+        # nginx serves root 0 at /storage/ and root N at /storage_N/
+        prefix = "/storage" if root == 0 else f"/storage_{root}"
+        return f"{prefix}/{path}"
+
+    def _get_weights(self) -> list[int]:
+        """Free bytes of every root, refreshed at most once per space_ttl seconds"""
+        now = self._clock()
+        if self._weights is None or now - self._weights_time > self.space_ttl:
+            weights = []
+            for path in self.paths:
+                Path(path).mkdir(parents=True, exist_ok=True)
+                weights.append(shutil.disk_usage(path).free)
+            self._weights, self._weights_time = weights, now
+        return self._weights
+
+    @staticmethod
+    def _get_score(key: str, root: int, weight: int) -> float:
+        digest = hashlib.blake2b(f"{key}/{root}".encode(), digest_size=8).digest()
+        unit = (int.from_bytes(digest, "big") + 0.5) / 2 ** 64
+        return -weight / math.log(unit)
+
+
+storage_roots = ShardedRoots(STORAGE_ROOTS)
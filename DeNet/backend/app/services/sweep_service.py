@@ -0,0 +1,206 @@
+"""Background removal of expired upload sessions and of the storages they left incomplete.
+Runs in the app lifespan or alone: python -m src.services.sweep_service [--once]"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+
+from ..db import database, db_utils
+from ..settings import (
+    UPLOAD_SESSION_TTL, SWEEP_INTERVAL, SWEEP_BATCH, SWEEP_PAUSE, FILE_SWEEP_INTERVAL, FILE_SWEEP_AGE
+)
+from .auth_service import upload_session_cache
+from .metrics_service import SWEEP_ERRORS, SWEPT_ORPHANS, observe_sweep_batch
+from .removal_service import FileRemover, StorageRemoval, delete_storages, file_remover
+from .root_service import StorageRoots
+
+STORAGE_DIR = re.compile(r"^user_(\d+)/storage_(\d+)$")
+BLOB_DIR = re.compile(r"^user_\d+/blobs/")
+
+
+def iter_stale_files(roots: StorageRoots, before: float) -> Iterator[tuple[str, int, str]]:
+    """Walks all roots and yields (kind, root, relative path) of files and storage directories
+    not modified since before: "temp" - temporary files of interrupted uploads,
+    "blob" - content-addressed blobs, "storage" - directories of storages.
+    Cell files are never stat'ed. A blob is created by renaming it into its directory,
+    which updates the directory mtime, so blobs are stat'ed only in recently modified directories.
+    Blocking"""
+    for root in range(len(roots.paths)):
+        base = roots.get_root_path(root)
+        for directory, dir_names, file_names in os.walk(base):
+            relative = os.path.relpath(directory, base).replace(os.sep, "/")
+            try:
+                recent = os.stat(directory).st_mtime >= before
+            except FileNotFoundError:
+                continue
+            if STORAGE_DIR.match(relative) and not recent:
+                yield "storage", root, relative
+            blob_dir = BLOB_DIR.match(relative + "/") is not None
+            for name in file_names:
+                temp = name.endswith(".tmp")
+                if not temp and not blob_dir:
+                    continue
+                # a temporary file may still be written long after it was created
+                if temp or recent:
+                    try:
+                        if os.stat(os.path.join(directory, name)).st_mtime >= before:
+                            continue
+                    except FileNotFoundError:
+                        continue
+                yield ("temp" if temp else "blob"), root, f"{relative}/{name}"
+
+
+class Sweeper:
+    """Every interval seconds removes upload sessions older than ttl by batches of batch_size.
+    A session of a complete storage is just deleted, an incomplete storage is deleted with its cells,
+    its files and the blobs no other cell refers to. Incomplete storages left without a session are
+    deleted the same way. Once per file_interval seconds the disks are scanned for files older than
+    file_age which nothing refers to"""
+
+    def __init__(self, session_maker, remover: FileRemover, ttl: float = UPLOAD_SESSION_TTL,
+                 interval: float = SWEEP_INTERVAL, batch_size: int = SWEEP_BATCH, pause: float = SWEEP_PAUSE,
+                 file_interval: float = FILE_SWEEP_INTERVAL, file_age: float = FILE_SWEEP_AGE):
+        self._session_maker = session_maker
+        self.remover = remover
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.file_interval = file_interval
+        self.file_age = file_age
+        self._next_file_sweep = 0.0
+        self._task = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run_forever(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+                if time.monotonic() >= self._next_file_sweep:
+                    await self.sweep_files()
+                    self._next_file_sweep = time.monotonic() + self.file_interval
+            except Exception:
+                SWEEP_ERRORS.inc()
+                logging.exception("Sweep failed")
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> int:
+        """Removes all sessions expired by now and the incomplete storages without a session,
+        returns the number of sessions"""
+        total = 0
+        while True:
+            swept = await self._sweep_batch()
+            total += swept
+            if swept < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        after = None
+        while True:
+            after = await self._sweep_orphan_batch(after)
+            if after is None:
+                return total
+            await asyncio.sleep(self.pause)
+
+    async def sweep_files(self) -> None:
+        """Schedules removal of stale temporary files, unreferenced blobs
+        and directories of storages which are not in the database"""
+        files = iter_stale_files(self.remover.roots, time.time() - self.file_age)
+        while chunk := await asyncio.to_thread(list, itertools.islice(files, self.batch_size)):
+            await self._sweep_file_batch(chunk)
+            await asyncio.sleep(self.pause)
+
+    async def _sweep_batch(self) -> int:
+        start = time.perf_counter()
+        before = datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+        async with self._session_maker() as session:
+            expired = await db_utils.get_expired_sessions(before, self.batch_size, session)
+            if not expired:
+                return 0
+            abandoned = list({row.storage_id for row in expired if not row.completed})
+            await db_utils.delete_upload_sessions([row.session for row in expired], session)
+            removal = await delete_storages(abandoned, session)
+            await session.commit()
+        for row in expired:
+            upload_session_cache.invalidate(str(row.session))
+        for storage_id in abandoned:
+            upload_session_cache.invalidate_storage(storage_id)
+        self.remover.schedule(removal)
+        observe_sweep_batch(len(expired) - len(abandoned), len(abandoned), time.perf_counter() - start)
+        return len(expired)
+
+    async def _sweep_orphan_batch(self, after: int | None) -> int | None:
+        """Deletes a batch of incomplete storages older than ttl without a session,
+        e.g. created by an older version which committed the storage and its session apart.
+        Only incomplete storages are walked. Returns the cursor of the next batch"""
+        before = datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+        async with self._session_maker() as session:
+            orphans = await db_utils.get_orphan_storages(before, after, self.batch_size, session)
+            if not orphans:
+                return None
+            removal = await delete_storages([row.id for row in orphans], session)
+            await session.commit()
+        for storage_id, _ in removal.storages:
+            upload_session_cache.invalidate_storage(storage_id)
+        self.remover.schedule(removal)
+        SWEPT_ORPHANS.labels("storage").inc(len(removal.storages))
+        return orphans[-1].id if len(orphans) == self.batch_size else None
+
+    async def _sweep_file_batch(self, chunk: list[tuple[str, int, str]]) -> None:
+        temps = [(root, path) for kind, root, path in chunk if kind == "temp"]
+        blobs = [(root, path) for kind, root, path in chunk if kind == "blob"]
+        storage_dirs = {
+            int(match.group(2)): int(match.group(1))
+            for kind, _, path in chunk if kind == "storage" and (match := STORAGE_DIR.match(path))
+        }
+        async with self._session_maker() as session:
+            referenced = await db_utils.get_referenced_paths([path for _, path in blobs], session)
+            existing = await db_utils.get_existing_storages(list(storage_dirs), session)
+        removal = StorageRemoval(
+            [(storage_id, user_id) for storage_id, user_id in storage_dirs.items() if storage_id not in existing],
+            # the remover checks the blobs again under their lock
+            [(root, path) for root, path in blobs if path not in referenced],
+            temps,
+        )
+        self.remover.schedule(removal)
+        SWEPT_ORPHANS.labels("storage_dir").inc(len(removal.storages))
+        SWEPT_ORPHANS.labels("blob").inc(len(removal.blobs))
+        SWEPT_ORPHANS.labels("temp").inc(len(removal.files))
+
+
+async def main(once: bool) -> None:
+    file_remover.start(database.get_db_session())
+    sweeper = Sweeper(database.get_db_session(), file_remover)
+    try:
+        if once:
+            swept = await sweeper.sweep()
+            await sweeper.sweep_files()
+            await file_remover.join()
+            logging.warning("Swept %s upload sessions", swept)
+        else:
+            await sweeper.run_forever()
+    finally:
+        await file_remover.stop()
+        await database.get_engine().dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Removes expired upload sessions and incomplete storages")
+    parser.add_argument("--once", action="store_true", help="Sweep once and exit")
+    asyncio.run(main(parser.parse_args().once))
@@ -1,6 +1,7 @@
 from pydantic_settings import BaseSettings
 from pydantic_core import ValidationError
 from pydantic import Field
+from typing import Literal
 
 
 class APISettings(BaseSettings):
@@ -9,6 +10,46 @@ class APISettings(BaseSettings):
     database_password: str
     debug: bool = False
     database_url: str
+    # full SQLAlchemy URL, overrides the postgres settings above (e.g. sqlite+aiosqlite for benchmarks)
+    database_dsn: str | None = None
+    auth_cache_size: int = 10000
+    auth_cache_ttl: float = 60
+    upload_session_cache_size: int = 10000
+    upload_session_cache_ttl: float = 300
+    cell_size: int = 1024 * 1024
+    cell_size_min: int = 64 * 1024
+    cell_size_max: int = 64 * 1024 * 1024
+    # limits of one storage, a packed storage reserves all its bytes on upload_init
+    storage_max_cells: int = 1_000_000
+    storage_max_bytes: int = 1024 ** 4
+    # group commit of cell rows: a batch is committed when it has cell_batch_rows rows
+    # or cell_batch_delay seconds after its first row
+    cell_batch_rows: int = 500
+    cell_batch_delay: float = 0.005
+    # directories for cell files, usually one per disk. Only append new ones, cells refer to roots by index
+    storage_roots: list[str] = ["storage"]
+    # free space of the roots is re-read at most once per storage_space_ttl seconds
+    storage_space_ttl: float = 10
+    # upload sessions expire after upload_session_ttl seconds, storages they haven't completed are deleted
+    upload_session_ttl: float = 24 * 60 * 60
+    sweeper_enabled: bool = True
+    sweep_interval: float = 300
+    sweep_batch: int = 100
+    # pause between batches of one sweep, leaves the database to the requests
+    sweep_pause: float = 0.1
+    # the disks are scanned for leftovers (temporary files, unreferenced blobs, directories of missing storages)
+    # once per file_sweep_interval seconds, only files older than file_sweep_age seconds are removed
+    file_sweep_interval: float = 60 * 60
+    file_sweep_age: float = 60 * 60
+    # files of deleted storages are removed by removal_workers threads, at most removal_rate files/s (0 - no limit)
+    removal_workers: int = 2
+    removal_rate: float = 1000
+    # cell files are written by disk_io_workers threads of their own, not by the default executor
+    disk_io_workers: int = 16
+    # none - no sync, fdatasync - every cell file is synced before the answer,
+    # group - cells written within durability_group_delay seconds are synced together
+    durability: Literal["none", "fdatasync", "group"] = "group"
+    durability_group_delay: float = 0.002
 
 try:
     Settings = APISettings().model_dump()
@@ -20,3 +61,29 @@ DATABASE_USER = Settings.get("database_user")
 DATABASE_PASSWORD = Settings.get("database_password")
 DEBUG = Settings.get("debug")
 DATABASE_URL = Settings.get("database_url")
+DATABASE_DSN = Settings.get("database_dsn")
+AUTH_CACHE_SIZE = Settings.get("auth_cache_size")
+AUTH_CACHE_TTL = Settings.get("auth_cache_ttl")
+UPLOAD_SESSION_CACHE_SIZE = Settings.get("upload_session_cache_size")
+UPLOAD_SESSION_CACHE_TTL = Settings.get("upload_session_cache_ttl")
+CELL_SIZE = Settings.get("cell_size")
+CELL_SIZE_MIN = Settings.get("cell_size_min")
+CELL_SIZE_MAX = Settings.get("cell_size_max")
+STORAGE_MAX_CELLS = Settings.get("storage_max_cells")
+STORAGE_MAX_BYTES = Settings.get("storage_max_bytes")
+CELL_BATCH_ROWS = Settings.get("cell_batch_rows")
+CELL_BATCH_DELAY = Settings.get("cell_batch_delay")
+STORAGE_ROOTS = Settings.get("storage_roots")
+STORAGE_SPACE_TTL = Settings.get("storage_space_ttl")
+UPLOAD_SESSION_TTL = Settings.get("upload_session_ttl")
+SWEEPER_ENABLED = Settings.get("sweeper_enabled")
+SWEEP_INTERVAL = Settings.get("sweep_interval")
+SWEEP_BATCH = Settings.get("sweep_batch")
+SWEEP_PAUSE = Settings.get("sweep_pause")
+FILE_SWEEP_INTERVAL = Settings.get("file_sweep_interval")
+FILE_SWEEP_AGE = Settings.get("file_sweep_age")
+REMOVAL_WORKERS = Settings.get("removal_workers")
+REMOVAL_RATE = Settings.get("removal_rate")
+DISK_IO_WORKERS = Settings.get("disk_io_workers")
+DURABILITY = Settings.get("durability")
+DURABILITY_GROUP_DELAY = Settings.get("durability_group_delay")
@@ -0,0 +1,50 @@
+-- Brings a database created by the first version of the app to the current models.
+-- The app creates missing tables (e.g. members) on start, but create_all never alters existing ones.
+-- Safe to run more than once:
+--   docker compose exec -T database sh -c 'psql -U $POSTGRES_USER -d $POSTGRES_DB' < migrations/upgrade.sql
+BEGIN;
+
+-- users: api-key authentication looks users up by key, the key is unique
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_api_key ON users (api_key);
+
+-- storage: layout, compression, cell size, backend root and archive flag;
+-- old storages are file-per-cell, uncompressed, 1 MiB cells on the first root
+ALTER TABLE storage ADD COLUMN IF NOT EXISTS layout VARCHAR DEFAULT 'cells' NOT NULL;
+ALTER TABLE storage ADD COLUMN IF NOT EXISTS codec VARCHAR DEFAULT 'none' NOT NULL;
+ALTER TABLE storage ADD COLUMN IF NOT EXISTS cell_size INTEGER DEFAULT '1048576' NOT NULL;
+ALTER TABLE storage ADD COLUMN IF NOT EXISTS root INTEGER DEFAULT '0' NOT NULL;
+ALTER TABLE storage ADD COLUMN IF NOT EXISTS archive BOOLEAN DEFAULT false NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_storage_user_id_id ON storage (user_id, id);
+
+-- storage: the counter of committed cells and the completed flag, old storages count as created now
+ALTER TABLE storage ADD COLUMN IF NOT EXISTS uploaded INTEGER DEFAULT '0' NOT NULL;
+ALTER TABLE storage ADD COLUMN IF NOT EXISTS completed BOOLEAN DEFAULT false NOT NULL;
+ALTER TABLE storage ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL;
+UPDATE storage SET uploaded = counts.uploaded, completed = counts.uploaded >= storage.size
+FROM (
+    SELECT storage.id, count(cells.id) AS uploaded
+    FROM storage LEFT JOIN cells ON cells.storage_id = storage.id
+    GROUP BY storage.id
+) AS counts
+WHERE counts.id = storage.id;
+CREATE INDEX IF NOT EXISTS ix_storage_completed_id ON storage (completed, id);
+
+-- cells: content-addressed cells share a blob path, so the path is no longer unique;
+-- (storage_id, address) goes first in the unique index to serve manifest pages
+ALTER TABLE cells DROP CONSTRAINT IF EXISTS cells_path_key;
+ALTER TABLE cells DROP CONSTRAINT IF EXISTS cells_address_storage_id_key;
+ALTER TABLE cells DROP CONSTRAINT IF EXISTS cells_storage_id_address_key;
+ALTER TABLE cells ADD CONSTRAINT cells_storage_id_address_key UNIQUE (storage_id, address);
+ALTER TABLE cells ADD COLUMN IF NOT EXISTS digest VARCHAR(64);
+ALTER TABLE cells ADD COLUMN IF NOT EXISTS "offset" BIGINT;
+ALTER TABLE cells ADD COLUMN IF NOT EXISTS length INTEGER;
+ALTER TABLE cells ADD COLUMN IF NOT EXISTS root INTEGER DEFAULT '0' NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_cells_path ON cells (path);
+CREATE INDEX IF NOT EXISTS ix_cells_digest ON cells (digest);
+
+-- upload sessions: existing sessions count as created now and expire after UPLOAD_SESSION_TTL
+ALTER TABLE uploadsessions ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_uploadsessions_created_at ON uploadsessions (created_at);
+CREATE INDEX IF NOT EXISTS ix_uploadsessions_storage_id ON uploadsessions (storage_id);
+
+COMMIT;
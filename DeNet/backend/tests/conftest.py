@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# settings are read on import, the app runs on SQLite in a temporary directory
+WORKDIR = Path(tempfile.mkdtemp(prefix="denet_tests_"))
+os.environ.update({
+    "DATABASE": "tests",
+    "DATABASE_USER": "tests",
+    "DATABASE_PASSWORD": "tests",
+    "DATABASE_URL": "localhost",
+    "DATABASE_DSN": f"sqlite+aiosqlite:///{WORKDIR / 'tests.db'}",
+    "STORAGE_ROOTS": f'["{WORKDIR / "storage"}"]',
+    "SWEEPER_ENABLED": "false",
+})
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+API_KEY = "TESTS"
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from app.api_app.app import app
+
+    with TestClient(app) as client:
+        client.post("/register", json={"name": "tests", "api_key": API_KEY})
+        yield client
@@ -0,0 +1,193 @@
+"""Requests must not load more than they answer with: the number of SQL statements of an endpoint
+doesn't depend on how many storages and cells the user has, and the rows it fetches are bounded
+by the page it returns"""
+import hashlib
+
+import pytest
+from sqlalchemy import event
+
+from conftest import API_KEY
+
+HEADERS = {"api-key": API_KEY}
+CELL_SIZE = 64 * 1024
+BIG_CELLS = 40
+
+
+class QueryCounter:
+    """Records every statement of the engine with the number of rows it returned"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.rows = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+        # the aiosqlite adapter fetches the whole result right after execute
+        self.rows.append(len(getattr(cursor, "_rows", ())) if cursor.description else 0)
+
+    def __enter__(self):
+        event.listen(self.engine, "after_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "after_cursor_execute", self)
+
+
+class Storage:
+    def __init__(self, client, cells: int, archive: bool = False, uploaded: int | None = None):
+        init = client.post("/upload_init", headers=HEADERS, json={
+            "size": cells, "name": "file.bin", "cell_size": CELL_SIZE, "archive": archive,
+        }).json()
+        self.id = init["pk"]
+        self.session = init["session"]
+        self.cells = cells
+        self.headers = {**HEADERS, "session": self.session}
+        for address in range(cells if uploaded is None else uploaded):
+            response = client.put(f"/cells/{self.id}/{address}", headers=self.headers, content=self.body(address))
+            assert response.status_code == 201
+
+    @staticmethod
+    def body(address: int) -> bytes:
+        return address.to_bytes(4, "big") * (CELL_SIZE // 4)
+
+
+def count_queries(client, method: str, url: str, status: int = 200, **kwargs):
+    from app.db.database import get_engine
+    from app.services.auth_service import auth_cache, upload_session_cache
+
+    # the api-key and upload session lookups are counted too
+    auth_cache.clear()
+    upload_session_cache.clear()
+    kwargs.setdefault("headers", HEADERS)
+    with QueryCounter(get_engine().sync_engine) as counter:
+        response = client.request(method, url, **kwargs)
+    assert response.status_code == status, response.text
+    return len(counter.statements), sum(counter.rows), response
+
+
+@pytest.fixture(scope="module")
+def storages(client):
+    small = Storage(client, 1)
+    # user with many storages and a storage with many cells
+    for _ in range(30):
+        Storage(client, 1)
+    big = Storage(client, BIG_CELLS)
+    return small, big
+
+
+@pytest.fixture(scope="module")
+def archive(client):
+    storage = Storage(client, 1, archive=True)
+    members = [{"name": f"dir/{index}", "offset": index, "length": 1} for index in range(30)]
+    response = client.post("/members", headers=storage.headers, json={"start": 0, "members": members})
+    assert response.status_code == 201
+    return storage
+
+
+def test_storage_list(client, storages):
+    statements, rows, response = count_queries(client, "GET", "/storage?limit=10")
+    # the user by api-key, one page of storages
+    assert statements == 2
+    assert rows == 1 + 10
+    assert len(response.json()["storage_list"]) == 10
+
+
+def test_whole_file(client, storages):
+    small, big = storages
+    small_statements, _, response = count_queries(client, "GET", f"/files/{small.id}")
+    assert len(response.content) == CELL_SIZE
+    big_statements, rows, response = count_queries(client, "GET", f"/files/{big.id}")
+    assert len(response.content) == BIG_CELLS * CELL_SIZE
+    # the user by api-key, the storage, its last cell for the length, the cells of the range
+    assert small_statements == big_statements == 4
+    assert rows == 1 + 1 + 1 + BIG_CELLS
+
+
+def test_file_range(client, storages):
+    _, big = storages
+    start, end = 10 * CELL_SIZE + 100, 11 * CELL_SIZE + 99
+    statements, rows, response = count_queries(
+        client, "GET", f"/files/{big.id}", status=206, headers={**HEADERS, "range": f"bytes={start}-{end}"}
+    )
+    # only the two cells the range covers are fetched
+    assert statements == 4
+    assert rows == 1 + 1 + 1 + 2
+    assert response.content == (big.body(10) + big.body(11))[100:CELL_SIZE + 100]
+
+
+def test_download_init(client, storages):
+    small, big = storages
+    small_statements, _, _ = count_queries(client, "GET", "/download_init", json={"id": small.id})
+    big_statements, rows, response = count_queries(client, "GET", "/download_init", json={"id": big.id})
+    # the user by api-key, the storage, its cells
+    assert small_statements == big_statements == 3
+    assert rows == 1 + 1 + BIG_CELLS
+    assert len(response.json()["cells"]) == BIG_CELLS
+
+
+def test_manifest(client, storages):
+    _, big = storages
+    statements, rows, response = count_queries(client, "GET", f"/manifest/{big.id}?limit=10")
+    # the user by api-key, the storage, one page of cells
+    assert statements == 3
+    assert rows == 1 + 1 + 10
+    assert response.json()["cells"]["address"] == list(range(10))
+
+
+def test_upload_status(client, storages):
+    small, big = storages
+    small_statements, _, _ = count_queries(client, "GET", "/upload_status", headers=small.headers)
+    big_statements, rows, response = count_queries(client, "GET", "/upload_status", headers=big.headers)
+    # the user by api-key, the storage of the session, addresses of its cells
+    assert small_statements == big_statements == 3
+    assert rows == 1 + 1 + BIG_CELLS
+    assert response.json()["missing"] == []
+
+
+def test_known_cells(client, storages):
+    digests = [hashlib.sha256(str(index).encode()).hexdigest() for index in range(50)]
+    statements, rows, response = count_queries(client, "POST", "/cells/known", json={"digests": digests})
+    # the user by api-key, the known blobs
+    assert statements == 2
+    assert rows == 1
+    assert response.json()["digests"] == []
+
+
+def test_download_cell(client, storages):
+    _, big = storages
+    path = client.get(f"/manifest/{big.id}", headers=HEADERS).json()["path_template"].format(address=3)
+    statements, rows, response = count_queries(
+        client, "GET", f"/download/{path}", status=302, follow_redirects=False
+    )
+    # the user by api-key, the owner of the cell
+    assert statements == 2
+    assert rows == 1 + 1
+    assert response.headers["x-accel-redirect"].endswith(path)
+
+
+def test_members(client, archive):
+    statements, rows, response = count_queries(client, "GET", f"/members/{archive.id}?limit=10")
+    # the user by api-key, the storage, one page of members
+    assert statements == 3
+    assert rows == 1 + 1 + 10
+    assert [member["name"] for member in response.json()["members"]] == [f"dir/{index}" for index in range(10)]
+
+
+def test_upload_cell(client):
+    storage = Storage(client, BIG_CELLS, uploaded=BIG_CELLS // 2)
+    for address in (BIG_CELLS // 2, BIG_CELLS - 1):
+        statements, rows, _ = count_queries(
+            client, "PUT", f"/cells/{storage.id}/{address}", status=201,
+            headers=storage.headers, content=storage.body(address),
+        )
+        # the user by api-key, the storage of the session, the check that the cell is not stored yet,
+        # the insert of the cell row returning its id, the update of the storage counter
+        assert statements == 5
+        assert rows == 1 + 1 + 0 + 1 + 0
+    statements, rows, _ = count_queries(
+        client, "PUT", f"/cells/{storage.id}/0", status=409, headers=storage.headers, content=storage.body(0),
+    )
+    # a duplicate is rejected before its body is read
+    assert statements == 3
+    assert rows == 1 + 1 + 1
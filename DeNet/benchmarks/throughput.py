@@ -0,0 +1,202 @@
+"""
+End-to-end throughput benchmark.
+
+Runs the FastAPI app in-process (uvicorn on localhost, SQLite via aiosqlite
+instead of Postgres) and drives AsyncAPIClient upload and whole-file download
+over a matrix of file sizes, cell sizes and concurrency levels.
+Prints machine-readable JSON: MB/s, requests/s and p50/p95/p99 latency per endpoint.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/throughput.py --sizes 16 64 --cell-sizes 256 1024 --concurrency 1 8 --output bench.json
+
+Cell downloads through /download need nginx (X-Accel-Redirect), so downloads
+are measured with the /files endpoint which the app serves itself.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR / "backend"))
+sys.path.insert(0, str(BASE_DIR / "CLI"))
+
+MiB = 1024 * 1024
+API_KEY = "BENCHMARK"
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def endpoint_name(method, path):
+    """Route template of the request: numeric path segments become {id}"""
+    return f"{method} {re.sub(r'/[0-9]+(?=/|$)', '/{id}', path)}"
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    index = max(0, -(-len(ordered) * percent // 100) - 1)
+    return ordered[index]
+
+
+def make_trace_config(latencies):
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        latencies[endpoint_name(params.method, params.url.path)].append(time.perf_counter() - context.start)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def make_file(path, size):
+    with open(path, "wb") as f:
+        for start in range(0, size, MiB):
+            f.write(os.urandom(min(MiB, size - start)))
+
+
+def file_digest(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(MiB):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class Server:
+    """uvicorn running the app in a background thread"""
+
+    def __init__(self, app, port):
+        import uvicorn
+
+        config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("Server failed to start")
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+async def run_case(server_url, workdir, file_size, cell_size, concurrency):
+    from services.api_client import AsyncAPIClient
+
+    source = workdir / f"source_{file_size}"
+    if not source.exists():
+        make_file(source, file_size)
+    target_dir = workdir / "download"
+    target_dir.mkdir(exist_ok=True)
+
+    result = {"file_size": file_size, "cell_size": cell_size, "concurrency": concurrency}
+    for operation in ("upload", "download"):
+        latencies = defaultdict(list)
+        async with AsyncAPIClient(server_url, API_KEY, limit=concurrency,
+                                  trace_configs=[make_trace_config(latencies)]) as client:
+            start = time.perf_counter()
+            if operation == "upload":
+                storage_id = await client.upload_file(
+                    source, window=concurrency, max_memory=None, dedup=False, cell_size=cell_size
+                )
+            else:
+                downloaded = await client.download_whole(storage_id, target_dir, parts=concurrency)
+            elapsed = time.perf_counter() - start
+        requests = sum(len(values) for values in latencies.values())
+        result[operation] = {
+            "seconds": elapsed,
+            "mb_per_s": file_size / MiB / elapsed,
+            "requests": requests,
+            "requests_per_s": requests / elapsed,
+            "latency": {
+                name: {
+                    "count": len(values),
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                    "p99": percentile(values, 99),
+                }
+                for name, values in latencies.items()
+            },
+        }
+    result["verified"] = file_digest(source) == file_digest(downloaded)
+    os.remove(downloaded)
+    return result
+
+
+async def run_matrix(server_url, workdir, sizes, cell_sizes, concurrency_levels):
+    from services.api_client import AsyncAPIClient
+
+    async with AsyncAPIClient(server_url, API_KEY) as client:
+        await client.register("benchmark")
+    results = []
+    for file_size in sizes:
+        for cell_size in cell_sizes:
+            for concurrency in concurrency_levels:
+                results.append(await run_case(server_url, workdir, file_size, cell_size, concurrency))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1, 16, 64], help="File sizes, MiB")
+    parser.add_argument("--cell-sizes", nargs="+", type=int, default=[256, 1024, 4096], help="Cell sizes, KiB")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16], help="Cells or ranges in flight")
+    parser.add_argument("--output", default=None, help="JSON output file, stdout by default")
+    parser.add_argument("--workdir", default=None, help="Directory for the database, storage and test files")
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="denet_bench_")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    output = Path(args.output).resolve() if args.output else None
+    os.environ.update({
+        "DATABASE": "benchmark",
+        "DATABASE_USER": "benchmark",
+        "DATABASE_PASSWORD": "benchmark",
+        "DATABASE_URL": "localhost",
+        "DATABASE_DSN": f"sqlite+aiosqlite:///{workdir / 'benchmark.db'}",
+    })
+    # the app keeps cells in a directory relative to the working directory
+    os.chdir(workdir)
+    from app.api_app.app import app
+
+    port = get_free_port()
+    with Server(app, port):
+        results = asyncio.run(run_matrix(
+            f"http://127.0.0.1:{port}", workdir,
+            [size * MiB for size in args.sizes],
+            [size * 1024 for size in args.cell_sizes],
+            args.concurrency,
+        ))
+    report = json.dumps({"results": results}, indent=2)
+    if output:
+        output.write_text(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()